@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the per-tweet cost of utils.cleanup with the schema-compiled
+transformer, after checking that they produce the same rows.
+
+Usage: python bench_cleanup.py [number-of-tweets]
+"""
+
+import collections
+import json
+import sys
+import time
+
+import tweets
+import utils
+
+# Schema fields that cleanup() drops anyway.
+CLEANUP_SKIPS = ('media',)
+
+
+def bench(name, fn, data, unit='tweet', repeat=3):
+    """Runs fn over every item in data, and prints the best per-item time."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for item in data:
+            fn(item)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print '%-12s %8.1f us/%s' % (name, best * 1e6 / len(data), unit)
+
+
+def differences(fields, projected, cleaned, path=''):
+    """Yields the paths of the schema fields where a row projected by the
+    compiled transformer disagrees with the output of cleanup(). cleanup()
+    also drops zeros, and fields it leaves out on purpose, so those aren't
+    differences.
+    """
+    for field in fields:
+        if field['name'] in CLEANUP_SKIPS:
+            continue
+        name = path + field['name']
+        a = projected.get(field['name'])
+        b = cleaned.get(field['name'])
+        if field['type'] != 'RECORD':
+            if field.get('mode') == 'REPEATED' and a is not None:
+                a = [x for x in a if x != 0] or None
+            if a != b and not (a == 0 and b is None):
+                yield name
+        elif field.get('mode') == 'REPEATED':
+            a, b = a or [], b or []
+            if len(a) != len(b):
+                yield name
+                continue
+            for i, (x, y) in enumerate(zip(a, b)):
+                for d in differences(field['fields'], x, y,
+                                     '%s[%d].' % (name, i)):
+                    yield d
+        elif a is not None or b is not None:
+            if not isinstance(a, dict) or not isinstance(b, dict):
+                yield name
+                continue
+            for d in differences(field['fields'], a, b, name + '.'):
+                yield d
+
+
+def check(fields, transform, data):
+    """Prints how many tweets the transformer and cleanup() disagree on,
+    and where. Returns whether they agree on all of them."""
+    found = collections.Counter()
+    for tweet in data:
+        found.update(set(differences(fields, transform(tweet),
+                                     utils.cleanup(tweet))))
+    print 'differences: %s' % (
+            ', '.join('%s (%s tweets)' % item
+                      for item in found.most_common()) or 'none')
+    return not found
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    data = [json.loads(line) for line in tweets.corpus(n)]
+    data = [t for t in data if 'delete' not in t and 'limit' not in t]
+    fields = utils.load_schema()
+    transform = utils.compile_schema(fields)
+    print 'tweets: %s (%s with a place)' % (
+            len(data), sum(1 for t in data if t.get('place')))
+    if not check(fields, transform, data):
+        sys.exit(1)
+    bench('cleanup', utils.cleanup, data)
+    bench('transform', transform, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the JSON libraries that utils.load_codec can use, for decoding
+stream frames and encoding insertAll request bodies.
+
+Usage: python bench_json.py [number-of-frames]
+"""
+
+import sys
+
+from bench_cleanup import bench
+import tweets
+import utils
+
+
+def decode_frame(codec):
+    """Returns a function that decodes a frame unless it is a control frame,
+    the way the consumers do.
+    """
+    def decode(data):
+        if not utils.is_control_frame(data):
+            codec.loads(data)
+    return decode
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    data = tweets.corpus(n)
+    transform = utils.compile_schema(utils.load_schema())
+    rows = [transform(utils.loads(line)) for line in data
+            if not utils.is_control_frame(line)]
+    bodies = [{'rows': [{'json': row} for row in rows[i:i + 500]]}
+              for i in xrange(0, len(rows), 500)]
+    print 'frames: %s, tweets: %s' % (len(data), len(rows))
+    for name in utils.JSON_CODECS:
+        codec = utils.load_codec(name)
+        if codec.__name__ != name:
+            print '%-12s not installed' % name
+            continue
+        bench(name + ' loads', codec.loads, data, unit='frame')
+        bench(name + ' skip', decode_frame(codec), data, unit='frame')
+        bench(name + ' dumps', codec.dumps, bodies, unit='batch')
+
+
+if __name__ == '__main__':
+    main()
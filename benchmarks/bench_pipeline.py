@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays a tweet corpus through one of the pipelines, end to end, against
+the stand-in services in fakes.py, and reports its throughput, the latency
+from a tweet arriving from the stream to its row being inserted, and the CPU
+time used per row.
+
+The producer and consumer scripts run in this process: the corpus is fed to
+the producer's stream listener from a background thread, and the consumer's
+main() runs until every tweet has been inserted, or --timeout passes.
+
+Usage: python bench_pipeline.py redis|pubsub [options]
+
+Settings that aren't options, such as BQ_BATCH_MAX_ROWS or
+PUBSUB_PULL_STREAMS, are read from the environment, as in the pipelines.
+So is RUNTIME: with 'gevent', the pipelines run on greenlets, as they do
+under controller.py.
+"""
+
+import os
+
+if os.environ.get('RUNTIME') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import collections
+import imp
+import json
+import resource
+import sys
+import threading
+import time
+
+import fakes
+import tweets
+
+SCRIPTS = {
+    'redis': ('redis', 'redis-pipe-image',
+              'twitter-to-redis.py', 'redis-to-bigquery.py'),
+    'pubsub': ('pubsub', 'pubsub-pipe-image',
+               'twitter-to-pubsub.py', 'pubsub-to-bigquery.py'),
+}
+
+# The environment the pipeline scripts need, unless it's already set.
+ENVIRONMENT = {
+    'PROJECT_ID': 'bench-project',
+    'BQ_DATASET': 'bench',
+    'BQ_TABLE': 'tweets',
+    'CONSUMERKEY': 'unused',
+    'CONSUMERSECRET': 'unused',
+    'ACCESSTOKEN': 'unused',
+    'ACCESSTOKENSEC': 'unused',
+    'TWSTREAMMODE': 'sample',
+    'REDISMASTER_SERVICE_HOST': 'localhost',
+    'REDISMASTER_SERVICE_PORT': '6379',
+    'REDISLIST': 'bench-tweets',
+    # Wake up regularly, to notice when the benchmark is over.
+    'REDIS_BLOCK_TIMEOUT': '1',
+    'PUBSUB_TOPIC': 'projects/bench-project/topics/tweets',
+}
+
+
+class Recorder(object):
+    """Records when each tweet was sent, and when its row was inserted.
+
+    done is set once rows have been inserted for all of the expected
+    tweets, other than those the pipeline is known to have lost.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        # The number of tweets that won't be inserted, by reason.
+        self.lost = {}
+        self.sent = {}
+        self.latencies = {}
+        # The number of rows inserted into each table.
+        self.tables = collections.Counter()
+        self.last_insert = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def send(self, id_str):
+        self.sent[id_str] = time.time()
+
+    def on_insert(self, table, rows):
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                id_str = row.get('insertId')
+                if id_str in self.sent and id_str not in self.latencies:
+                    self.latencies[id_str] = now - self.sent[id_str]
+            self.tables[table] += len(rows)
+            self.last_insert = now
+            self._check()
+
+    def lose(self, reason, count):
+        """Set the number of tweets lost for reason, which won't be waited
+        for."""
+        with self._lock:
+            self.lost[reason] = count
+            self._check()
+
+    def remaining(self):
+        """The number of tweets that can still be inserted."""
+        return self.expected - sum(self.lost.values())
+
+    def _check(self):
+        if len(self.latencies) >= self.remaining():
+            self.done.set()
+
+
+def load_frames(args):
+    """Returns the corpus, as a list of (frame, tweet id) pairs. The id is
+    None for frames that aren't tweets."""
+    if args.corpus:
+        with open(args.corpus) as f:
+            data = [line.rstrip('\n') for line in f if line.strip()]
+    else:
+        data = tweets.corpus(args.frames, args.seed)
+    frames = []
+    for line in data:
+        frame = json.loads(line)
+        id_str = None
+        if 'delete' not in frame and 'limit' not in frame:
+            id_str = frame.get('id_str')
+        frames.append((line, id_str))
+    return frames
+
+
+def load_pipeline(args):
+    """Set up the environment and the fakes, and load the producer and
+    consumer scripts. Returns (producer, consumer, utils, services)."""
+    for name, value in ENVIRONMENT.iteritems():
+        os.environ.setdefault(name, value)
+    if args.reliable:
+        os.environ['REDIS_RELIABLE_QUEUE'] = 'true'
+    if args.redis:
+        host, _, port = args.redis.partition(':')
+        os.environ['REDISMASTER_SERVICE_HOST'] = host
+        os.environ['REDISMASTER_SERVICE_PORT'] = port or '6379'
+    top, image, producer_script, consumer_script = SCRIPTS[args.pipeline]
+    path = os.path.join(tweets.ROOT, top, image)
+    # Each image has its own utils module.
+    sys.path.insert(0, path)
+    import utils
+
+    if args.pipeline == 'redis':
+        if args.redis:
+            import redis
+            redis.StrictRedis(
+                    host=os.environ['REDISMASTER_SERVICE_HOST'],
+                    port=os.environ['REDISMASTER_SERVICE_PORT']).delete(
+                            os.environ['REDISLIST'])
+        else:
+            fakes.patch_redis()
+    producer = imp.load_source('producer', os.path.join(path, producer_script))
+    consumer = imp.load_source('consumer', os.path.join(path, consumer_script))
+
+    # Fields are added to the schema right away, rather than after giving
+    # BigQuery time to see them.
+    utils.SCHEMA_SETTLE_TIME = 0
+    services = {'bigquery': fakes.FakeBigQuery(
+            None, latency=args.bq_latency, jitter=args.bq_latency / 2,
+            error_rate=args.error_rate, row_error_rate=args.row_error_rate,
+            schema=utils.load_schema(), seed=args.seed)}
+    consumer.bigquery_clients = utils.ClientPool(lambda: services['bigquery'])
+    if args.pipeline == 'pubsub':
+        services['pubsub'] = fakes.FakePubSub(
+                latency=args.pubsub_latency, jitter=args.pubsub_latency / 2,
+                error_rate=args.error_rate, seed=args.seed)
+        pool = utils.ClientPool(lambda: services['pubsub'])
+        producer.pubsub_clients = pool
+        consumer.pubsub_clients = pool
+    return producer, consumer, utils, services
+
+
+def replay(producer, frames, rate, recorder):
+    """Feed the frames to the producer's stream listener, at up to rate
+    frames per second (0 means as fast as possible)."""
+    listener = producer.StdOutListener()
+    start = time.time()
+    for i, (frame, id_str) in enumerate(frames):
+        if rate:
+            delay = start + float(i) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if id_str is not None:
+            recorder.send(id_str)
+        listener.on_data(frame)
+    writer = getattr(listener, 'writer', None)
+    if writer is not None:
+        writer.close()
+        # The Redis producer drops tweets when its buffer is full; don't
+        # wait for those.
+        if writer.dropped:
+            recorder.lose('dropped by the producer', writer.dropped)
+    else:
+        listener.publisher.close()
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('pipeline', choices=sorted(SCRIPTS))
+    parser.add_argument('--frames', type=int, default=20000,
+                        help='number of synthetic stream frames to replay')
+    parser.add_argument('--corpus',
+                        help='replay this file of stream frames, one per '
+                        'line, instead of a synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='frames per second to replay; 0 means as fast '
+                        'as possible')
+    parser.add_argument('--bq-latency', type=float, default=0.05,
+                        help='seconds taken by each insertAll request')
+    parser.add_argument('--pubsub-latency', type=float, default=0.01,
+                        help='seconds taken by each Pub/Sub request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of insertAll and pull requests that '
+                        'fail')
+    parser.add_argument('--row-error-rate', type=float, default=0,
+                        help='fraction of rows that insertAll fails to insert')
+    parser.add_argument('--reliable', action='store_true',
+                        help='use the reliable Redis queue mode')
+    parser.add_argument('--redis', metavar='HOST:PORT',
+                        help='use this Redis server rather than fakeredis')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='give up after this many seconds')
+    args = parser.parse_args()
+
+    frames = load_frames(args)
+    expected = len(set(id_str for _, id_str in frames if id_str is not None))
+    recorder = Recorder(expected)
+    producer, consumer, utils, services = load_pipeline(args)
+    services['bigquery'].on_insert = recorder.on_insert
+    inserters = []
+    create_inserter = consumer.create_inserter
+
+    def record_inserter(*arguments):
+        inserter = create_inserter(*arguments)
+        inserters.append(inserter)
+        return inserter
+    consumer.create_inserter = record_inserter
+
+    def finish():
+        deadline = time.time() + args.timeout
+        while not recorder.done.wait(0.5) and time.time() < deadline:
+            # Rows the Redis consumer gives up on aren't read again (in
+            # reliable mode, not until it exits), so don't wait for them.
+            # Pub/Sub redelivers them.
+            if args.pipeline == 'redis' and inserters:
+                recorder.lose('given up on by the inserter',
+                              inserters[-1].failed)
+        consumer.stopping.set()
+
+    print 'replaying %s frames (%s tweets) through the %s pipeline' % (
+            len(frames), expected, args.pipeline)
+    start = time.time()
+    start_cpu = cpu_time()
+    replayer = threading.Thread(
+            target=replay, args=(producer, frames, args.rate, recorder))
+    replayer.daemon = True
+    replayer.start()
+    finisher = threading.Thread(target=finish)
+    finisher.daemon = True
+    finisher.start()
+    # The consumer runs in the main thread, since it sets a signal handler.
+    consumer.main()
+    cpu = cpu_time() - start_cpu
+    elapsed = (recorder.last_insert or time.time()) - start
+    if 'pubsub' in services:
+        # Let the consumer's pull threads finish before the process exits.
+        services['pubsub'].close()
+        time.sleep(0.5)
+
+    rows = len(recorder.latencies)
+    latencies = sorted(recorder.latencies.values())
+    print
+    print 'rows inserted:  %s of %s%s' % (
+            rows, recorder.remaining(),
+            '' if recorder.done.is_set() else ' (timed out)')
+    for reason, count in sorted(recorder.lost.iteritems()):
+        if count:
+            print 'rows lost:      %s %s' % (count, reason)
+    print 'elapsed:        %.2f s' % elapsed
+    print 'throughput:     %.0f rows/s' % (rows / elapsed if elapsed else 0)
+    print 'latency p50:    %.1f ms' % (percentile(latencies, 0.5) * 1000)
+    print 'latency p99:    %.1f ms' % (percentile(latencies, 0.99) * 1000)
+    print 'latency max:    %.1f ms' % (percentile(latencies, 1) * 1000)
+    print 'CPU per row:    %.0f us' % (cpu * 1e6 / rows if rows else 0)
+    print 'tables:         %s' % len(recorder.tables)
+    print 'schema patches: %s' % services['bigquery'].patches
+    for name, service in sorted(services.iteritems()):
+        print '%-15s %s requests, %s failed' % (
+                name + ':', service.requests, service.errors)
+
+
+if __name__ == '__main__':
+    main()
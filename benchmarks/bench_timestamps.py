@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark for parsing tweet 'created_at' timestamps.
+
+Compares dateutil's generic parser with utils.parse_timestamp, both on
+distinct values (every lookup misses the cache) and on the 'created_at'
+values of a synthetic stream, where many are repeated.
+
+Usage: python bench_timestamps.py [number-of-values]
+"""
+
+import json
+import sys
+
+import dateutil.parser
+
+from bench_cleanup import bench
+import tweets
+import utils
+
+
+def dateutil_parse(value):
+    return str(dateutil.parser.parse(value))
+
+
+def stream_values(n):
+    """The 'created_at' values found in n stream frames, in stream order."""
+    values = []
+    for line in tweets.corpus(n):
+        tweet = json.loads(line)
+        while tweet:
+            if 'created_at' in tweet:
+                values.append(tweet['created_at'])
+                values.append(tweet['user']['created_at'])
+            tweet = tweet.get('retweeted_status')
+    return values
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    distinct = [tweets.created_at(i) for i in xrange(n)]
+    stream = stream_values(n)
+    print 'distinct values: %s' % len(distinct)
+    bench('dateutil', dateutil_parse, distinct, 'value')
+    bench('fixed', utils._parse_twitter_time, distinct, 'value')
+    print 'stream values: %s (%s distinct)' % (len(stream), len(set(stream)))
+    bench('dateutil', dateutil_parse, stream, 'value')
+    # A single pass, so that the cache starts out empty.
+    bench('cached', utils.parse_timestamp, stream, 'value', repeat=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for the services the pipelines talk to, used by
+bench_pipeline.py: BigQuery's insertAll and load jobs, Pub/Sub's publish
+and pull, and (with fakeredis) Redis.
+
+The BigQuery and Pub/Sub fakes answer through objects shaped like the
+apiclient resources, so the pipeline code runs unchanged. Each request can
+be delayed, and insertAll, load and pull requests can be made to fail, to
+see how the pipelines cope with slow or flaky services.
+"""
+
+import collections
+import functools
+import gzip
+import itertools
+import json
+import random
+import threading
+import time
+
+from apiclient import errors
+import httplib2
+
+
+class Request(object):
+    """Stands in for an apiclient HttpRequest."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self, num_retries=0):
+        return self.fn()
+
+
+class Service(object):
+    """Delays requests by latency seconds, plus up to jitter more, and fails
+    a fraction error_rate of the requests that can fail with a 503.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def _request(self, fn, can_fail=True):
+        def run():
+            delay = self.latency + self._random.random() * self.jitter
+            if delay:
+                time.sleep(delay)
+            self.requests += 1
+            if can_fail and self._random.random() < self.error_rate:
+                self.errors += 1
+                raise errors.HttpError(httplib2.Response({'status': 503}),
+                                       '{"error": {"code": 503}}')
+            return fn()
+        return Request(run)
+
+
+class FakeBigQuery(Service):
+    """Accepts insertAll requests and load jobs, and hands the inserted rows
+    to on_insert, in the insertAll format.
+
+    A fraction row_error_rate of the rows in successful insertAll requests
+    are reported as failed with a retryable error, instead of being
+    inserted. Load jobs finish as soon as they're submitted. All the tables
+    share the schema fields, which tables().patch() replaces.
+    """
+
+    def __init__(self, on_insert, row_error_rate=0.0, schema=(), **kwargs):
+        super(FakeBigQuery, self).__init__(**kwargs)
+        self.on_insert = on_insert
+        self.row_error_rate = row_error_rate
+        self.schema = list(schema)
+        self.patches = 0
+        self.jobs_by_id = {}
+
+    def tabledata(self):
+        return self
+
+    def tables(self):
+        return FakeTables(self)
+
+    def jobs(self):
+        return self
+
+    def insert(self, projectId, body, media_body):
+        def load():
+            table = body['configuration']['load']['destinationTable']
+            stream = media_body.stream()
+            stream.seek(0)
+            with gzip.GzipFile(fileobj=stream) as f:
+                rows = [json.loads(line) for line in f]
+            self.on_insert(table['tableId'],
+                           [{'json': row, 'insertId': row.get('id_str')}
+                            for row in rows])
+            job = dict(body, status={'state': 'DONE'})
+            self.jobs_by_id[body['jobReference']['jobId']] = job
+            return job
+        return self._request(load)
+
+    def get(self, projectId, jobId):
+        return Request(lambda: self.jobs_by_id[jobId])
+
+    def insertAll(self, projectId, datasetId, tableId, body):
+        def insert():
+            inserted = []
+            insert_errors = []
+            for index, row in enumerate(body['rows']):
+                if self._random.random() < self.row_error_rate:
+                    insert_errors.append({
+                            'index': index,
+                            'errors': [{'reason': 'backendError'}]})
+                else:
+                    inserted.append(row)
+            # Rows with a template suffix go to a table created from tableId.
+            self.on_insert(tableId + body.get('templateSuffix', ''), inserted)
+            response = {'kind': 'bigquery#tableDataInsertAllResponse'}
+            if insert_errors:
+                response['insertErrors'] = insert_errors
+            return response
+        return self._request(insert)
+
+
+class FakeTables(object):
+    """The tables resource of a FakeBigQuery."""
+
+    def __init__(self, bigquery):
+        self.bigquery = bigquery
+
+    def get(self, projectId, datasetId, tableId):
+        return self.bigquery._request(
+                lambda: {'schema': {'fields': self.bigquery.schema}},
+                can_fail=False)
+
+    def patch(self, projectId, datasetId, tableId, body):
+        def patch():
+            self.bigquery.schema = body['schema']['fields']
+            self.bigquery.patches += 1
+            return {'schema': {'fields': self.bigquery.schema}}
+        return self.bigquery._request(patch)
+
+
+class FakePubSub(Service):
+    """A single topic with a single subscription, kept in memory.
+
+    Messages that are pulled stay outstanding until they're acknowledged;
+    setting their ack deadline to 0 puts them back to be pulled again. A
+    pull with nothing to return waits for up to pull_wait seconds, like a
+    pull that doesn't return immediately.
+    """
+
+    def __init__(self, pull_wait=1.0, **kwargs):
+        super(FakePubSub, self).__init__(**kwargs)
+        self.pull_wait = pull_wait
+        self.messages = collections.deque()
+        self.outstanding = {}
+        self.acked = 0
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def close(self):
+        """Make pulls return right away from now on."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def projects(self):
+        return self
+
+    def topics(self):
+        return self
+
+    def subscriptions(self):
+        return self
+
+    def create(self, name, body):
+        return Request(lambda: {'name': name})
+
+    def get(self, subscription):
+        return Request(lambda: {'name': subscription,
+                                'ackDeadlineSeconds': 10})
+
+    def publish(self, topic, body):
+        def publish():
+            ids = []
+            with self._cond:
+                for message in body['messages']:
+                    message_id = str(next(self._ids))
+                    self.messages.append((message_id, message['data']))
+                    ids.append(message_id)
+                self._cond.notify_all()
+            return {'messageIds': ids}
+        return self._request(publish, can_fail=False)
+
+    def pull(self, subscription, body):
+        def pull():
+            received = []
+            with self._cond:
+                if not self.messages and not self.closed:
+                    self._cond.wait(self.pull_wait)
+                while (self.messages and
+                       len(received) < body.get('maxMessages', 100)):
+                    ack_id, data = self.messages.popleft()
+                    self.outstanding[ack_id] = data
+                    received.append({'ackId': ack_id,
+                                     'message': {'data': data,
+                                                 'messageId': ack_id}})
+            if not received:
+                return {}
+            return {'receivedMessages': received}
+        return self._request(pull)
+
+    def acknowledge(self, subscription, body):
+        def acknowledge():
+            with self._cond:
+                for ack_id in body['ackIds']:
+                    if self.outstanding.pop(ack_id, None) is not None:
+                        self.acked += 1
+            return {}
+        return self._request(acknowledge, can_fail=False)
+
+    def modifyAckDeadline(self, subscription, body):
+        def modify():
+            if body['ackDeadlineSeconds'] == 0:
+                with self._cond:
+                    for ack_id in body['ackIds']:
+                        data = self.outstanding.pop(ack_id, None)
+                        if data is not None:
+                            self.messages.appendleft((ack_id, data))
+                    self._cond.notify_all()
+            return {}
+        return self._request(modify, can_fail=False)
+
+
+def patch_redis():
+    """Make redis.StrictRedis return a single shared fakeredis instance, and
+    return it.
+
+    fakeredis doesn't implement register_script, so scripts are run with
+    EVAL instead. Its Lua runtime (lupa) is newer than Redis's, and only
+    has table.unpack; it also decodes strings as UTF-8 by default, which
+    packed items aren't.
+    """
+    import fakeredis
+    import lupa
+    import redis
+
+    lupa.LuaRuntime = functools.partial(lupa.LuaRuntime, encoding=None)
+
+    server = fakeredis.FakeStrictRedis()
+    server.flushall()
+
+    class Script(object):
+        def __init__(self, text):
+            self.text = 'local unpack = unpack or table.unpack\n' + text
+
+        def __call__(self, keys=(), args=()):
+            return server.eval(self.text, len(keys),
+                               *(list(keys) + list(args)))
+
+    server.register_script = Script
+    redis.StrictRedis = lambda *args, **kwargs: server
+    return server
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic tweet corpus used by the benchmark scripts.
+
+The generated tweets have the shape of Twitter Streaming API payloads,
+including the fields the BigQuery schema doesn't know about, so that they
+exercise the same code paths as live data.
+"""
+
+import datetime
+import json
+import os
+import random
+import sys
+
+# The benchmarks use the pipeline code from the redis image; the utils
+# module is the same in both images.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'redis', 'redis-pipe-image'))
+
+# Streams start at this time; tweets are spread evenly over the seconds
+# that follow it.
+START = datetime.datetime(2018, 10, 10, 20, 0, 0)
+LANGS = ['en', 'en', 'en', 'es', 'ja', 'pt', 'fr']
+
+
+def created_at(second):
+    """A 'created_at' string in the Twitter format."""
+    t = START + datetime.timedelta(seconds=second)
+    return t.strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+
+def make_user(rnd, uid):
+    return {
+        'id': uid,
+        'id_str': str(uid),
+        'name': 'User %d' % uid,
+        'screen_name': 'user%d' % uid,
+        'location': 'Somewhere',
+        'url': None,
+        'description': 'Just a synthetic user. ' * rnd.randint(0, 4),
+        'protected': False,
+        'verified': rnd.random() < 0.05,
+        'followers_count': rnd.randint(0, 100000),
+        'friends_count': rnd.randint(0, 5000),
+        'listed_count': rnd.randint(0, 100),
+        'favourites_count': rnd.randint(0, 10000),
+        'statuses_count': rnd.randint(0, 50000),
+        'created_at': created_at(-uid * 3600),
+        'utc_offset': None,
+        'time_zone': None,
+        'geo_enabled': False,
+        'lang': rnd.choice(LANGS),
+        'contributors_enabled': False,
+        'is_translator': False,
+        'translator_type': 'none',
+        'profile_background_color': 'C0DEED',
+        'profile_background_image_url': 'http://abs.twimg.com/bg.png',
+        'profile_background_image_url_https': 'https://abs.twimg.com/bg.png',
+        'profile_background_tile': False,
+        'profile_link_color': '1DA1F2',
+        'profile_sidebar_border_color': 'C0DEED',
+        'profile_sidebar_fill_color': 'DDEEF6',
+        'profile_text_color': '333333',
+        'profile_use_background_image': True,
+        'profile_image_url': 'http://pbs.twimg.com/p/%d.jpg' % uid,
+        'profile_image_url_https': 'https://pbs.twimg.com/p/%d.jpg' % uid,
+        'default_profile': True,
+        'default_profile_image': False,
+        'following': None,
+        'follow_request_sent': None,
+        'notifications': None,
+    }
+
+
+def make_entities(rnd):
+    return {
+        'hashtags': [{'text': 'tag%d' % i, 'indices': [i * 5, i * 5 + 4]}
+                     for i in range(rnd.randint(0, 3))],
+        'urls': [{'url': 'https://t.co/x', 'expanded_url': 'http://x.com/',
+                  'display_url': 'x.com', 'indices': [10, 33]}],
+        'user_mentions': [],
+        'symbols': [],
+        'media': [{
+            'id': 1, 'id_str': '1', 'indices': [0, 23],
+            'media_url': 'http://pbs.twimg.com/m/1.jpg',
+            'media_url_https': 'https://pbs.twimg.com/m/1.jpg',
+            'url': 'https://t.co/m', 'display_url': 'pic.twitter.com/m',
+            'expanded_url': 'https://twitter.com/m', 'type': 'photo',
+            'sizes': {'thumb': {'w': 150, 'h': 150, 'resize': 'crop'},
+                      'large': {'w': 1024, 'h': 768, 'resize': 'fit'}},
+            'video_info': {'aspect_ratio': [4, 3], 'variants': []},
+        }] if rnd.random() < 0.2 else [],
+    }
+
+
+def make_status(rnd, tid, second, users=10 ** 6):
+    return {
+        'created_at': created_at(second),
+        'id': tid,
+        'id_str': str(tid),
+        'text': 'Synthetic tweet number %d about #tech' % tid,
+        'display_text_range': [0, 40],
+        'source': '<a href="http://twitter.com">Twitter Web Client</a>',
+        'truncated': False,
+        'in_reply_to_status_id': None,
+        'in_reply_to_status_id_str': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_user_id_str': None,
+        'in_reply_to_screen_name': None,
+        'user': make_user(rnd, rnd.randint(1, users)),
+        'geo': None,
+        'coordinates': None,
+        'place': None,
+        'contributors': None,
+        'is_quote_status': False,
+        'quote_count': 0,
+        'reply_count': 0,
+        'retweet_count': rnd.randint(0, 1000),
+        'favorite_count': rnd.randint(0, 1000),
+        'entities': make_entities(rnd),
+        'favorited': False,
+        'retweeted': False,
+        'filter_level': 'low',
+        'lang': rnd.choice(LANGS),
+        'timestamp_ms': str(1539202764000 + second * 1000),
+    }
+
+
+def make_tweet(rnd, tid, second):
+    """Returns a single synthetic tweet as a dict."""
+    tweet = make_status(rnd, tid, second)
+    if rnd.random() < 0.1:
+        tweet['coordinates'] = {'type': 'Point',
+                                'coordinates': [-122.08, 37.42]}
+        tweet['geo'] = {'type': 'Point', 'coordinates': [37.42, -122.08]}
+        tweet['place'] = {
+            'id': 'abc', 'url': 'https://api.twitter.com/place/abc.json',
+            'place_type': 'city', 'name': 'Mountain View',
+            'full_name': 'Mountain View, CA', 'country_code': 'US',
+            'country': 'United States', 'attributes': {},
+            'bounding_box': {'type': 'Polygon', 'coordinates': [[
+                [-122.1, 37.3], [-122.1, 37.4], [-122.0, 37.4],
+                [-122.0, 37.3]]]}}
+    if rnd.random() < 0.4:
+        tweet['retweeted_status'] = make_status(rnd, tid - 1000, second - 60,
+                                                users=1000)
+    if rnd.random() < 0.1:
+        tweet['quoted_status'] = make_status(rnd, tid - 2000, second - 120)
+        tweet['quoted_status_id_str'] = str(tid - 2000)
+    if rnd.random() < 0.2:
+        tweet['extended_tweet'] = {'full_text': tweet['text'] * 3,
+                                   'display_text_range': [0, 120]}
+    return tweet
+
+
+def make_frame(rnd, tid, second):
+    """Returns a stream frame: usually a tweet, sometimes delete/limit."""
+    p = rnd.random()
+    if p < 0.05:
+        return {'delete': {'status': {'id': tid, 'id_str': str(tid),
+                                      'user_id': 1, 'user_id_str': '1'},
+                           'timestamp_ms': '1539202764000'}}
+    if p < 0.06:
+        return {'limit': {'track': tid % 1000,
+                          'timestamp_ms': '1539202764000'}}
+    return make_tweet(rnd, tid, second)
+
+
+def corpus(n, seed=0, tweets_per_second=50):
+    """Returns n synthetic stream frames, as JSON strings."""
+    rnd = random.Random(seed)
+    base = 1050118621198921728
+    return [json.dumps(make_frame(rnd, base + i, i // tweets_per_second))
+            for i in xrange(n)]
+
+
+if __name__ == '__main__':
+    for line in corpus(int(sys.argv[1]) if len(sys.argv) > 1 else 10):
+        print line
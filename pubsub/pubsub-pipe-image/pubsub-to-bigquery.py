@@ -18,10 +18,13 @@ using the BigQuery Streaming API.
 
 import base64
 import datetime
-import json
 import os
+import Queue
+import signal
+import threading
 import time
 
+import metrics
 import utils
 
 # Get the project ID and pubsub topic from the environment variables set in
@@ -29,6 +32,111 @@ import utils
 PROJECT_ID = os.environ['PROJECT_ID']
 PUBSUB_TOPIC = os.environ['PUBSUB_TOPIC']
 NUM_RETRIES = 3
+# How rows are written to BigQuery: 'stream' sends them with streaming
+# inserts, and 'load' writes them to gzipped newline-delimited JSON files in
+# BQ_LOAD_DIR, which are loaded with load jobs once they hold
+# BQ_LOAD_MAX_BYTES of rows or are BQ_LOAD_MAX_AGE seconds old. Load jobs
+# are free, but rows take minutes rather than seconds to show up.
+BQ_SINK = os.environ.get('BQ_SINK', 'stream')
+BQ_LOAD_DIR = os.environ.get('BQ_LOAD_DIR', '/tmp/bq-load')
+BQ_LOAD_MAX_BYTES = int(os.environ.get('BQ_LOAD_MAX_BYTES', 100000000))
+BQ_LOAD_MAX_AGE = float(os.environ.get('BQ_LOAD_MAX_AGE', 300))
+# The number of concurrent BigQuery inserts, and the number of batches that
+# can wait for a free insert worker.
+BQ_INSERT_WORKERS = int(os.environ.get('BQ_INSERT_WORKERS', 4))
+BQ_INSERT_QUEUE_SIZE = int(os.environ.get('BQ_INSERT_QUEUE_SIZE', 8))
+# Batches are sent when they reach a row target, which adapts between
+# BQ_BATCH_MIN_ROWS and BQ_BATCH_MAX_ROWS to keep inserts within
+# BQ_TARGET_LATENCY seconds, when they reach BQ_BATCH_MAX_BYTES, or when
+# their oldest row has waited BQ_BATCH_MAX_LINGER seconds.
+BQ_BATCH_MIN_ROWS = int(os.environ.get('BQ_BATCH_MIN_ROWS', 50))
+BQ_BATCH_MAX_ROWS = int(os.environ.get('BQ_BATCH_MAX_ROWS', 500))
+BQ_BATCH_MAX_BYTES = int(os.environ.get('BQ_BATCH_MAX_BYTES', 5000000))
+BQ_BATCH_MAX_LINGER = float(os.environ.get('BQ_BATCH_MAX_LINGER', 2))
+BQ_TARGET_LATENCY = float(os.environ.get('BQ_TARGET_LATENCY', 1))
+# Which table each row goes to: 'none' sends them all to BQ_TABLE, 'day' to
+# the partition of BQ_TABLE for the day they were created (BQ_TABLE must be
+# a day-partitioned table), 'lang' to a table per language, e.g.
+# BQ_TABLE_en, and 'keyword' to a table per keyword, the first one in the
+# comma-separated BQ_ROUTING_KEYWORDS found in their text. Each table gets
+# batches of its own.
+BQ_ROUTING = os.environ.get('BQ_ROUTING', 'none')
+BQ_ROUTING_KEYWORDS = os.environ.get('BQ_ROUTING_KEYWORDS', '').split(',')
+# If 'true', fields that tweets have and the table's schema doesn't are
+# added to the schema as they show up, every BQ_SCHEMA_UPDATE_INTERVAL
+# seconds, rather than being dropped.
+BQ_SCHEMA_UPDATES = os.environ.get('BQ_SCHEMA_UPDATES') == 'true'
+BQ_SCHEMA_UPDATE_INTERVAL = float(os.environ.get('BQ_SCHEMA_UPDATE_INTERVAL',
+                                                 60))
+# If set, rows that can't be inserted into BigQuery, or that wait more than
+# BQ_SPILL_AFTER seconds for an insert worker, are written to a spill log
+# on local disk in this directory, and inserted from there once BigQuery
+# keeps up again. The log holds up to BQ_SPILL_MAX_BYTES, in segments of
+# BQ_SPILL_SEGMENT_BYTES, and is replayed in batches of BQ_SPILL_REPLAY_ROWS.
+BQ_SPILL_DIR = os.environ.get('BQ_SPILL_DIR')
+BQ_SPILL_AFTER = float(os.environ.get('BQ_SPILL_AFTER', 10))
+BQ_SPILL_MAX_BYTES = int(os.environ.get('BQ_SPILL_MAX_BYTES', 1000000000))
+BQ_SPILL_SEGMENT_BYTES = int(os.environ.get('BQ_SPILL_SEGMENT_BYTES',
+                                            16000000))
+BQ_SPILL_REPLAY_ROWS = int(os.environ.get('BQ_SPILL_REPLAY_ROWS', 500))
+# If set, rows that BigQuery rejects as invalid are published to this topic,
+# along with their errors, instead of being dropped.
+BQ_DEAD_LETTER_TOPIC = os.environ.get('BQ_DEAD_LETTER_TOPIC')
+# The number of recently seen tweet ids to remember, to drop duplicates.
+DEDUP_CACHE_SIZE = int(os.environ.get('DEDUP_CACHE_SIZE', 100000))
+# The ack deadline, in seconds, for messages on the subscription. Messages
+# are acknowledged once their tweets are written to BigQuery; until then,
+# their deadlines are extended so they aren't redelivered, starting as soon
+# as they're pulled. A subscription that already exists keeps its own
+# deadline, which is used instead if it's longer.
+PUBSUB_ACK_DEADLINE = int(os.environ.get('PUBSUB_ACK_DEADLINE', 60))
+# The number of pull requests to keep open at once, and the most messages
+# each one can return. Pulling pauses while PUBSUB_MAX_OUTSTANDING_MESSAGES
+# messages, or PUBSUB_MAX_OUTSTANDING_BYTES bytes of them, have been pulled
+# but not yet acknowledged.
+PUBSUB_PULL_STREAMS = int(os.environ.get('PUBSUB_PULL_STREAMS', 4))
+PUBSUB_MAX_MESSAGES = int(os.environ.get('PUBSUB_MAX_MESSAGES', 100))
+PUBSUB_MAX_OUTSTANDING_MESSAGES = int(
+        os.environ.get('PUBSUB_MAX_OUTSTANDING_MESSAGES', 5000))
+PUBSUB_MAX_OUTSTANDING_BYTES = int(
+        os.environ.get('PUBSUB_MAX_OUTSTANDING_BYTES', 50000000))
+# Set by controller.py when it runs several consumer processes: the file
+# this process writes its counters to, for the controller to add up.
+STATS_FILE = os.environ.get('STATS_FILE')
+
+# Set when the process is asked to stop, so that it finishes its inserts
+# before exiting.
+stopping = threading.Event()
+# The counters of earlier runs of main() in this process, which are
+# included in the stats file.
+run_totals = {}
+
+# Compile the table schema once, up front, into the tweet transformer. With
+# BQ_SCHEMA_UPDATES, it's compiled again whenever fields are added.
+schema_registry = utils.SchemaRegistry(utils.load_schema())
+# API clients, kept for reuse when main() is run again.
+bigquery_clients = utils.ClientPool(
+        lambda: utils.create_bigquery_client(utils.get_credentials()))
+pubsub_clients = utils.ClientPool(
+        lambda: utils.create_pubsub_client(utils.get_credentials()))
+
+TWEETS_READ = metrics.counter(
+        'tweets_read_total',
+        'Messages pulled from Pub/Sub: stream frames, or packed batches of '
+        'rows.')
+TWEETS_CLEANED = metrics.counter('tweets_cleaned_total',
+                                 'Tweets transformed into BigQuery rows.')
+DROPPED_CONTROL, DROPPED_INVALID, DROPPED_DUPLICATE = [
+        metrics.counter('tweets_dropped_total',
+                        'Stream frames not sent to BigQuery, by reason.',
+                        reason=reason)
+        for reason in ('control', 'invalid', 'duplicate')]
+FETCH_LATENCY = metrics.histogram(
+        'pubsub_fetch_latency_seconds',
+        'Time taken by a Pub/Sub pull request.')
+CLEANUP_TIME = metrics.histogram(
+        'tweet_cleanup_seconds', 'Time taken to transform a tweet into a row.',
+        metrics.TWEET_BUCKETS)
 
 
 def fqrn(resource_type, project, resource):
@@ -40,25 +148,40 @@ def create_subscription(client, project_name, sub_name):
     """Creates a new subscription to a given topic."""
     print "using pubsub topic: %s" % PUBSUB_TOPIC
     name = get_full_subscription_name(project_name, sub_name)
-    body = {'topic': PUBSUB_TOPIC}
+    body = {'topic': PUBSUB_TOPIC, 'ackDeadlineSeconds': PUBSUB_ACK_DEADLINE}
     subscription = client.projects().subscriptions().create(
             name=name, body=body).execute(num_retries=NUM_RETRIES)
     print 'Subscription {} was created.'.format(subscription['name'])
 
 
+def get_ack_deadline(client, subscription, default=PUBSUB_ACK_DEADLINE):
+    """Returns the ack deadline of the subscription, in seconds, or default
+    if it can't be read."""
+    try:
+        info = client.projects().subscriptions().get(
+                subscription=subscription).execute(num_retries=NUM_RETRIES)
+        return int(info.get('ackDeadlineSeconds', default))
+    except Exception, e:
+        print "Problem reading the subscription's ack deadline: %s" % e
+        return default
+
+
 def get_full_subscription_name(project, subscription):
     """Returns a fully qualified subscription name."""
     return fqrn('subscriptions', project, subscription)
 
 
-def pull_messages(client, project_name, sub_name):
-    """Pulls messages from a given subscription."""
-    BATCH_SIZE = 50
+def pull_messages(client, project_name, sub_name,
+                  max_messages=PUBSUB_MAX_MESSAGES):
+    """Pulls messages from a given subscription.
+
+    Returns a list of (ack ID, data) pairs. The messages aren't acknowledged.
+    """
     tweets = []
     subscription = get_full_subscription_name(project_name, sub_name)
     body = {
             'returnImmediately': False,
-            'maxMessages': BATCH_SIZE
+            'maxMessages': max_messages
     }
     try:
         resp = client.projects().subscriptions().pull(
@@ -70,74 +193,464 @@ def pull_messages(client, project_name, sub_name):
         return
     receivedMessages = resp.get('receivedMessages')
     if receivedMessages is not None:
-        ack_ids = []
         for receivedMessage in receivedMessages:
                 message = receivedMessage.get('message')
                 if message:
-                        tweets.append(
-                            base64.urlsafe_b64decode(str(message.get('data'))))
-                        ack_ids.append(receivedMessage.get('ackId'))
-        ack_body = {'ackIds': ack_ids}
-        client.projects().subscriptions().acknowledge(
-                subscription=subscription, body=ack_body).execute(
-                        num_retries=NUM_RETRIES)
+                        tweets.append((
+                            receivedMessage.get('ackId'),
+                            base64.urlsafe_b64decode(str(message.get('data')))))
     return tweets
 
 
-def write_to_bq(pubsub, sub_name, bigquery):
-    """Write the data to BigQuery in small chunks."""
-    tweets = []
-    CHUNK = 50  # The size of the BigQuery insertion batch.
-    # If no data on the subscription, the time to sleep in seconds
+class Acknowledger(object):
+    """Acknowledges messages once their tweets have been handled.
+
+    Acks are sent in batches from a background thread, which has its own
+    pubsub client. The thread also keeps extending the ack deadlines of the
+    messages that are still waiting to be written to BigQuery, so that they
+    aren't redelivered in the meantime.
+
+    It also provides flow control for pulling: wait_for_room() blocks while
+    too many messages, or bytes, are outstanding.
+    """
+
+    def __init__(self, client, subscription, ack_deadline=PUBSUB_ACK_DEADLINE,
+                 max_messages=PUBSUB_MAX_OUTSTANDING_MESSAGES,
+                 max_bytes=PUBSUB_MAX_OUTSTANDING_BYTES):
+        self.client = client
+        self.subscription = subscription
+        self.ack_deadline = ack_deadline
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        # The sizes of the outstanding messages, by ack ID.
+        self.outstanding = {}
+        self.outstanding_bytes = 0
+        self.acked = 0
+        self._lock = threading.Condition()
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def lease(self, messages):
+        """Start extending the deadlines of newly pulled messages, beginning
+        right away, since they were pulled with the subscription's deadline.
+        """
+        with self._lock:
+            for ack_id, data in messages:
+                self.outstanding[ack_id] = len(data)
+                self.outstanding_bytes += len(data)
+        self._queue.put(('lease', [ack_id for ack_id, _ in messages]))
+
+    def wait_for_room(self, stop=None):
+        """Wait until the outstanding messages are within the limits, or the
+        event stop is set."""
+        with self._lock:
+            while (len(self.outstanding) >= self.max_messages or
+                   self.outstanding_bytes >= self.max_bytes):
+                if stop is not None and stop.is_set():
+                    return
+                self._lock.wait(1)
+
+    def ack(self, ack_ids):
+        """Acknowledge messages that have been handled."""
+        self._release(ack_ids)
+        self._queue.put(('ack', ack_ids))
+
+    def nack(self, ack_ids):
+        """Give up on messages, so that they're redelivered right away."""
+        self._release(ack_ids)
+        self._queue.put(('nack', ack_ids))
+
+    def close(self):
+        """Send any pending acks, and stop the background thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _release(self, ack_ids):
+        with self._lock:
+            for ack_id in ack_ids:
+                self.outstanding_bytes -= self.outstanding.pop(ack_id, 0)
+            self._lock.notify_all()
+
+    def _call(self, method, ack_ids, **kwargs):
+        subscriptions = self.client.projects().subscriptions()
+        # Keep each request well under the API's size limit.
+        for i in range(0, len(ack_ids), 1000):
+            body = dict(kwargs, ackIds=ack_ids[i:i + 1000])
+            try:
+                getattr(subscriptions, method)(
+                        subscription=self.subscription, body=body).execute(
+                                num_retries=NUM_RETRIES)
+            except Exception, e:
+                print "Problem calling %s: %s" % (method, e)
+
+    def _run(self):
+        interval = self.ack_deadline / 3.0
+        next_extension = time.time() + interval
+        stopping = False
+        while not stopping:
+            leases, acks, nacks = [], [], []
+            try:
+                item = self._queue.get(
+                        timeout=max(0.01, next_extension - time.time()))
+                while True:
+                    if item is None:
+                        stopping = True
+                    elif item[0] == 'lease':
+                        leases.extend(item[1])
+                    elif item[0] == 'ack':
+                        acks.extend(item[1])
+                    else:
+                        nacks.extend(item[1])
+                    item = self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+            if acks:
+                self._call('acknowledge', acks)
+                self.acked += len(acks)
+            if nacks:
+                self._call('modifyAckDeadline', nacks, ackDeadlineSeconds=0)
+            if leases:
+                with self._lock:
+                    leases = [ack_id for ack_id in leases
+                              if ack_id in self.outstanding]
+                if leases:
+                    self._call('modifyAckDeadline', leases,
+                               ackDeadlineSeconds=self.ack_deadline)
+            if time.time() >= next_extension:
+                next_extension = time.time() + interval
+                with self._lock:
+                    outstanding = list(self.outstanding)
+                if outstanding:
+                    self._call('modifyAckDeadline', outstanding,
+                               ackDeadlineSeconds=self.ack_deadline)
+
+
+def dead_letter_publisher(clients, topic):
+    """Returns a function that publishes rows rejected by BigQuery to the
+    given topic. It can be called from any of the insert worker threads."""
+
+    def dead_letter(rejected):
+        messages = [{'data': base64.urlsafe_b64encode(utils.dumps(entry))}
+                    for entry in rejected]
+        client = clients.acquire()
+        try:
+            client.projects().topics().publish(
+                    topic=topic, body={'messages': messages}).execute(
+                            num_retries=NUM_RETRIES)
+        finally:
+            clients.release(client)
+    return dead_letter
+
+
+class Puller(object):
+    """Keeps several pull requests open at once, each from its own thread
+    and with its own pubsub client from the ClientPool clients. Pulled
+    messages are leased with the acknowledger, and handed over through a
+    queue."""
+
+    def __init__(self, clients, sub_name, acknowledger,
+                 streams=PUBSUB_PULL_STREAMS):
+        self.clients = clients
+        self.sub_name = sub_name
+        self.acknowledger = acknowledger
+        self.queue = Queue.Queue()
+        self._closed = threading.Event()
+        # Held while checking _closed and queueing pulled messages, so that
+        # close() sees all the messages queued before it.
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(streams):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def get(self, timeout):
+        """Returns the next list of pulled messages, or an empty list if
+        there are none within timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return []
+
+    def close(self, timeout=10):
+        """Stop pulling, and give back the messages that weren't taken.
+
+        Waits for up to timeout seconds for the pulls in flight to finish.
+        Messages that they, or any that take longer, return are given back
+        right away.
+        """
+        with self._lock:
+            self._closed.set()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        while True:
+            try:
+                messages = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.acknowledger.nack([ack_id for ack_id, _ in messages])
+
+    def _run(self):
+        client = self.clients.acquire()
+        try:
+            while not self._closed.is_set():
+                self.acknowledger.wait_for_room(self._closed)
+                start = time.time()
+                messages = pull_messages(client, PROJECT_ID, self.sub_name)
+                FETCH_LATENCY.observe(time.time() - start)
+                if not messages:
+                    continue
+                with self._lock:
+                    late = self._closed.is_set()
+                    if not late:
+                        self.acknowledger.lease(messages)
+                        self.queue.put(messages)
+                if late:
+                    self._give_back(client, messages)
+        finally:
+            self.clients.release(client)
+
+    def _give_back(self, client, messages):
+        """Make messages pulled after close() available again, without
+        going through the acknowledger, which may be closed by now."""
+        body = {'ackIds': [ack_id for ack_id, _ in messages],
+                'ackDeadlineSeconds': 0}
+        try:
+            client.projects().subscriptions().modifyAckDeadline(
+                    subscription=get_full_subscription_name(
+                            PROJECT_ID, self.sub_name),
+                    body=body).execute(num_retries=NUM_RETRIES)
+        except Exception, e:
+            print "Problem giving back pulled messages: %s" % e
+
+
+def create_inserter(dead_letter):
+    """Create the sink rows are written to BigQuery with: a
+    BigQueryInserter, or a BigQueryLoader if BQ_SINK is 'load'."""
+    if BQ_SINK == 'load':
+        print 'loading rows from files in %s' % BQ_LOAD_DIR
+        return utils.BigQueryLoader(
+                bigquery_clients, PROJECT_ID,
+                os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+                BQ_LOAD_DIR, BQ_LOAD_MAX_BYTES, BQ_LOAD_MAX_AGE,
+                schema=lambda: schema_registry.fields,
+                dead_letter=dead_letter)
+    spill = None
+    if BQ_SPILL_DIR:
+        # Each of the processes run by controller.py has its own log.
+        directory = os.path.join(BQ_SPILL_DIR,
+                                 os.environ.get('WORKER_INDEX', '0'))
+        spill = utils.SpillLog(directory, BQ_SPILL_MAX_BYTES,
+                               BQ_SPILL_SEGMENT_BYTES)
+    return utils.BigQueryInserter(
+            bigquery_clients, PROJECT_ID,
+            os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+            BQ_INSERT_WORKERS, BQ_INSERT_QUEUE_SIZE, dead_letter=dead_letter,
+            spill=spill, spill_after=BQ_SPILL_AFTER,
+            replay_rows=BQ_SPILL_REPLAY_ROWS)
+
+
+def stop(signum, frame):
+    """Signal handler that makes the write loop exit."""
+    stopping.set()
+
+
+def write_to_bq(puller, inserter, acknowledger):
+    """Write the data to BigQuery in small chunks, until count_max batches
+    have been sent or the process is asked to stop. Closes the puller,
+    inserter and acknowledger.
+    """
+
+    def send(rows, elements, destination=None):
+        def inserted(failed):
+            # The messages of rows that failed are redelivered, so their
+            # tweets mustn't be dropped as duplicates then.
+            for row in failed:
+                dedup.forget(row.get('id_str'))
+            failed = set(id(row) for row in failed)
+            acks, nacks = [], []
+            for row, element in zip(rows, elements):
+                if element.finish_row(id(row) in failed):
+                    (nacks if element.failed else acks).append(element.key)
+            acknowledger.ack(acks)
+            if nacks:
+                acknowledger.nack(nacks)
+        inserter.insert(rows, inserted, destination)
+
+    batcher = utils.Batcher(send, BQ_BATCH_MIN_ROWS,
+                            BQ_BATCH_MAX_ROWS, BQ_BATCH_MAX_BYTES,
+                            BQ_BATCH_MAX_LINGER, BQ_TARGET_LATENCY,
+                            utils.make_router(BQ_ROUTING,
+                                              os.environ['BQ_TABLE'],
+                                              BQ_ROUTING_KEYWORDS))
+    inserter.on_latency = batcher.record_latency
+    dedup = utils.DuplicateFilter(DEDUP_CACHE_SIZE)
+
+    def stats():
+        return {'batches': batcher.batches, 'rows': inserter.rows,
+                'rejected': inserter.rejected, 'failed': inserter.failed,
+                'duplicates': dedup.duplicates,
+                'acked': acknowledger.acked}
+
+    def save_stats():
+        if STATS_FILE:
+            utils.write_stats(STATS_FILE,
+                              utils.add_stats(dict(run_totals), stats()))
+
+    # If no data on the subscription, the time to wait in seconds
     # before checking again.
     WAIT = 2
     tweet = None
     mtweet = None
-    count = 0
     count_max = 50000
-    while count < count_max:
-        while len(tweets) < CHUNK:
-            twmessages = pull_messages(pubsub, PROJECT_ID, sub_name)
+    next_report = 25
+    try:
+        while batcher.batches < count_max and not stopping.is_set():
+            # Send off the pending tweets if they've waited long enough.
+            batcher.poll()
+            # Wait for new messages, or until it's time to send the
+            # pending tweets.
+            timeout = batcher.timeout()
+            twmessages = puller.get(WAIT if timeout is None else timeout)
             if twmessages:
-                for res in twmessages:
+                TWEETS_READ.inc(len(twmessages))
+                # Messages that won't be written to BigQuery.
+                skipped = []
+                cleaned = 0
+                for ack_id, res in twmessages:
+                    if utils.is_packed(res):
+                        # A batch of rows the producer has already projected.
+                        try:
+                            rows, size = utils.unpack_rows(res)
+                        except Exception, e:
+                            print 'Problem unpacking rows: %s' % e
+                            DROPPED_INVALID.inc()
+                            skipped.append(ack_id)
+                            continue
+                        # With no rows, nothing would ever finish the element.
+                        if not rows:
+                            skipped.append(ack_id)
+                            continue
+                        element = utils.Element(ack_id, len(rows))
+                        for row in rows:
+                            if dedup.is_duplicate(row.get('id_str')):
+                                DROPPED_DUPLICATE.inc()
+                                if element.finish_row():
+                                    if element.failed:
+                                        acknowledger.nack([ack_id])
+                                    else:
+                                        skipped.append(ack_id)
+                                continue
+                            cleaned += 1
+                            batcher.add(row, size / len(rows), element)
+                        continue
+                    # Only tweets go to BigQuery: skip 'delete' and 'limit'
+                    # notices, without parsing them when possible.
+                    if utils.is_control_frame(res):
+                        DROPPED_CONTROL.inc()
+                        skipped.append(ack_id)
+                        continue
+                    # Anything wrong with the message, from bad JSON to a
+                    # date that can't be parsed, drops it, rather than
+                    # failing the run: it would only be redelivered, and
+                    # fail it again.
                     try:
-                        tweet = json.loads(res)
+                        tweet = utils.loads(res)
+                        if not isinstance(tweet, dict):
+                            raise ValueError(
+                                    'Not a JSON object: %.100s' % res)
+                        if 'delete' in tweet or 'limit' in tweet:
+                            DROPPED_CONTROL.inc()
+                            skipped.append(ack_id)
+                            continue
+                        if dedup.is_duplicate(tweet.get('id_str')):
+                            DROPPED_DUPLICATE.inc()
+                            skipped.append(ack_id)
+                            continue
+                        # First do some massaging of the raw data
+                        start = time.time()
+                        mtweet = schema_registry.transform(tweet)
+                        CLEANUP_TIME.observe(time.time() - start)
                     except Exception, bqe:
-                        print bqe
-                    # First do some massaging of the raw data
-                    mtweet = utils.cleanup(tweet)
-                    # We only want to write tweets to BigQuery; we'll skip
-                    # 'delete' and 'limit' information.
-                    if 'delete' in mtweet:
+                        print 'Dropping invalid tweet: %s' % bqe
+                        DROPPED_INVALID.inc()
+                        skipped.append(ack_id)
                         continue
-                    if 'limit' in mtweet:
-                        continue
-                    tweets.append(mtweet)
-            else:
-                # pause before checking again
-                print 'sleeping...'
-                time.sleep(WAIT)
-        response = utils.bq_data_insert(bigquery, PROJECT_ID, os.environ['BQ_DATASET'],
-                             os.environ['BQ_TABLE'], tweets)
-        tweets = []
-        count += 1
-        if count % 25 == 0:
-            print ("processing count: %s of %s at %s: %s" %
-                   (count, count_max, datetime.datetime.now(), response))
+                    cleaned += 1
+                    batcher.add(mtweet, len(res), utils.Element(ack_id))
+                TWEETS_CLEANED.inc(cleaned)
+                if skipped:
+                    acknowledger.ack(skipped)
+            if batcher.batches >= next_report:
+                next_report += 25
+                print ("processing count: %s of %s at %s: %s rows inserted, "
+                       "%s rejected, %s failed, %s duplicates, "
+                       "%s messages acked, batch target %s rows" %
+                       (batcher.batches, count_max, datetime.datetime.now(),
+                        inserter.rows, inserter.rejected, inserter.failed,
+                        dedup.duplicates, acknowledger.acked, batcher.target))
+                save_stats()
+    finally:
+        batcher.close()
+        # Nack the messages still waiting to be processed, then wait for
+        # the inserts, and their acks, to finish.
+        puller.close()
+        inserter.close()
+        acknowledger.close()
+        save_stats()
+        utils.add_stats(run_totals, stats())
 
 
-if __name__ == '__main__':
+def main():
+    """Run the pipeline until count_max batches have been written, or the
+    process is asked to stop. Can be run again in the same process.
+    """
     topic_info = PUBSUB_TOPIC.split('/')
     topic_name = topic_info[-1]
     sub_name = "tweets-%s" % topic_name
     print "starting write to BigQuery...."
-    credentials = utils.get_credentials()
-    bigquery = utils.create_bigquery_client(credentials)
-    pubsub = utils.create_pubsub_client(credentials)
+    signal.signal(signal.SIGTERM, stop)
+    metrics.serve()
+    if BQ_SCHEMA_UPDATES:
+        schema_registry.start(bigquery_clients, PROJECT_ID,
+                              os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+                              BQ_SCHEMA_UPDATE_INTERVAL)
+    dead_letter = None
+    if BQ_DEAD_LETTER_TOPIC:
+        dead_letter = dead_letter_publisher(pubsub_clients,
+                                            BQ_DEAD_LETTER_TOPIC)
+    inserter = create_inserter(dead_letter)
+    pubsub = pubsub_clients.acquire()
     try:
         # TODO: check if subscription exists first
         subscription = create_subscription(pubsub, PROJECT_ID, sub_name)
     except Exception, e:
         print e
-    write_to_bq(pubsub, sub_name, bigquery)
+    subscription_name = get_full_subscription_name(PROJECT_ID, sub_name)
+    ack_deadline = get_ack_deadline(pubsub, subscription_name)
+    if ack_deadline != PUBSUB_ACK_DEADLINE:
+        print 'the subscription has an ack deadline of %s seconds' % (
+                ack_deadline)
+    acknowledger = Acknowledger(
+            pubsub, subscription_name,
+            ack_deadline=max(ack_deadline, PUBSUB_ACK_DEADLINE))
+    puller = Puller(pubsub_clients, sub_name, acknowledger)
+    metrics.gauge('pubsub_outstanding_messages',
+                  'Messages pulled from Pub/Sub but not yet acknowledged.',
+                  lambda: len(acknowledger.outstanding))
+    metrics.gauge('pubsub_pulled_batches',
+                  'Pulled batches of messages waiting to be processed.',
+                  puller.queue.qsize)
+    try:
+        write_to_bq(puller, inserter, acknowledger)
+    finally:
+        pubsub_clients.release(pubsub)
     print 'exited write loop'
+
+
+if __name__ == '__main__':
+    main()
@@ -20,10 +20,15 @@ to pull in tweets and publish them to a PubSub topic.
 import base64
 import datetime
 import os
+import Queue
+import threading
+import time
+
 from tweepy import OAuthHandler
 from tweepy import Stream
 from tweepy.streaming import StreamListener
 
+import metrics
 import utils
 
 # Get your twitter credentials from the environment variables.
@@ -35,6 +40,45 @@ access_token_secret = os.environ['ACCESSTOKENSEC']
 
 PUBSUB_TOPIC = os.environ['PUBSUB_TOPIC']
 NUM_RETRIES = 3
+# Tweets are published in batches of up to PUBLISH_BATCH_SIZE tweets or
+# PUBLISH_MAX_BYTES bytes, at least every PUBLISH_MAX_LINGER seconds, with
+# up to PUBLISH_WORKERS publish requests in flight. Once PUBLISH_QUEUE_SIZE
+# tweets are waiting to be published, reading the stream blocks.
+PUBLISH_BATCH_SIZE = int(os.environ.get('PUBLISH_BATCH_SIZE', 100))
+PUBLISH_MAX_BYTES = int(os.environ.get('PUBLISH_MAX_BYTES', 5000000))
+PUBLISH_MAX_LINGER = float(os.environ.get('PUBLISH_MAX_LINGER', 0.5))
+PUBLISH_WORKERS = int(os.environ.get('PUBLISH_WORKERS', 4))
+PUBLISH_QUEUE_SIZE = int(os.environ.get('PUBLISH_QUEUE_SIZE', 10000))
+# If "true", tweets are projected onto the BigQuery schema before they're
+# published, and each batch of them is published as a single compressed
+# message, which the consumers unpack. This makes the data in Pub/Sub
+# several times smaller, and saves the consumers the projection.
+PACK_TWEETS = os.environ.get('PACK_TWEETS') == 'true'
+
+# The tweet transformer used when packing tweets.
+transform = utils.compile_schema(utils.load_schema()) if PACK_TWEETS else None
+
+# Pubsub clients, kept for reuse when main() is run again.
+pubsub_clients = utils.ClientPool(
+        lambda: utils.create_pubsub_client(utils.get_credentials()))
+
+TWEETS_RECEIVED = metrics.counter('tweets_received_total',
+                                  'Stream frames received from Twitter.')
+TWEETS_PUBLISHED = metrics.counter('pubsub_published_total',
+                                   'Stream frames published to Pub/Sub.')
+PUBLISH_ERRORS = metrics.counter('pubsub_publish_errors_total',
+                                 'Failed publishes of a batch to Pub/Sub.')
+PUBLISH_BLOCKED = metrics.counter(
+        'pubsub_publish_blocked_total',
+        'Times reading the stream waited for the publish queue.')
+PUBLISHED_BYTES = metrics.counter(
+        'pubsub_published_bytes_total',
+        'Bytes of messages published to Pub/Sub, before base64 encoding.')
+PUBLISH_LATENCY = metrics.histogram('pubsub_publish_latency_seconds',
+                                    'Time taken to publish a batch.')
+PUBLISH_BATCH_MESSAGES = metrics.histogram(
+        'pubsub_publish_batch_messages', 'Messages per published batch.',
+        metrics.SIZE_BUCKETS)
 
 
 def publish(client, pubsub_topic, data_lines):
@@ -49,44 +93,159 @@ def publish(client, pubsub_topic, data_lines):
     return resp
 
 
+class Publisher(object):
+    """Publishes tweets to a topic in batches, from background threads.
+
+    One thread collects the tweets into batches, and a pool of workers,
+    each with its own pubsub client from the ClientPool clients, publishes
+    them. When the workers fall behind, the queues fill up and put() blocks.
+    If transform is given, each batch is projected with it, and published as
+    a single packed message (see utils.pack_frames).
+    """
+
+    def __init__(self, clients, topic, batch_size=PUBLISH_BATCH_SIZE,
+                 max_bytes=PUBLISH_MAX_BYTES, max_linger=PUBLISH_MAX_LINGER,
+                 workers=PUBLISH_WORKERS, queue_size=PUBLISH_QUEUE_SIZE,
+                 transform=None):
+        self.clients = clients
+        self.topic = topic
+        self.transform = transform
+        self.tweets = Queue.Queue(queue_size)
+        self.batches = Queue.Queue(workers)
+        self.batcher = utils.Batcher(self._send, batch_size, batch_size,
+                                     max_bytes, max_linger)
+        self.published = 0
+        self.errors = 0
+        self.blocked = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        metrics.gauge('pubsub_publish_queue_tweets',
+                      'Stream frames waiting to be published.',
+                      self.tweets.qsize)
+        self._batch_thread = threading.Thread(target=self._batch)
+        self._batch_thread.daemon = True
+        self._batch_thread.start()
+        self._workers = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._publish)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def put(self, tw):
+        """Queue a tweet for publishing, waiting if the queue is full."""
+        try:
+            self.tweets.put_nowait(tw)
+        except Queue.Full:
+            self.blocked += 1
+            PUBLISH_BLOCKED.inc()
+            self.tweets.put(tw)
+
+    def close(self):
+        """Publish all the queued tweets, and stop the background threads."""
+        self._closed.set()
+        self._batch_thread.join()
+        for _ in self._workers:
+            self.batches.put(None)
+        for thread in self._workers:
+            thread.join()
+
+    def _send(self, batch, _):
+        self.batches.put(batch)
+
+    def _batch(self):
+        while True:
+            timeout = self.batcher.timeout()
+            if timeout is None:
+                timeout = 0.5
+            try:
+                tw = self.tweets.get(timeout=timeout)
+            except Queue.Empty:
+                if self._closed.is_set():
+                    self.batcher.close()
+                    return
+            else:
+                self.batcher.add(tw, len(tw))
+            self.batcher.poll()
+
+    def _publish(self):
+        client = self.clients.acquire()
+        try:
+            self._publish_batches(client)
+        finally:
+            self.clients.release(client)
+
+    def _publish_batches(self, client):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            start = time.time()
+            messages = batch
+            if self.transform is not None:
+                packed = utils.pack_frames(batch, self.transform)
+                messages = [packed] if packed is not None else []
+            try:
+                if messages:
+                    publish(client, self.topic, messages)
+                with self._lock:
+                    self.published += len(batch)
+                TWEETS_PUBLISHED.inc(len(batch))
+                PUBLISHED_BYTES.inc(sum(len(message) for message in messages))
+                PUBLISH_LATENCY.observe(time.time() - start)
+                PUBLISH_BATCH_MESSAGES.observe(len(batch))
+            except Exception, e:
+                print 'Problem publishing to pubsub: %s' % e
+                with self._lock:
+                    self.errors += 1
+                PUBLISH_ERRORS.inc()
+
+
 class StdOutListener(StreamListener):
     """A listener handles tweets that are received from the stream.
     This listener dumps the tweets into a PubSub topic
     """
 
     count = 0
-    twstring = ''
-    tweets = []
-    batch_size = 50
     total_tweets = 10000000
-    client = utils.create_pubsub_client(utils.get_credentials())
+
+    def __init__(self, api=None):
+        super(StdOutListener, self).__init__(api)
+        self.publisher = Publisher(pubsub_clients, PUBSUB_TOPIC,
+                                   transform=transform)
 
     def write_to_pubsub(self, tw):
-        publish(self.client, PUBSUB_TOPIC, tw)
+        self.publisher.put(tw)
 
     def on_data(self, data):
         """What to do when tweet data is received."""
-        self.tweets.append(data)
-        if len(self.tweets) >= self.batch_size:
-            self.write_to_pubsub(self.tweets)
-            self.tweets = []
+        self.write_to_pubsub(data)
         self.count += 1
-        # if we've grabbed more than total_tweets tweets, exit the script.
-        # If this script is being run in the context of a kubernetes
-        # replicationController, the pod will be restarted fresh when
-        # that happens.
+        TWEETS_RECEIVED.inc()
+        # if we've grabbed more than total_tweets tweets, stop streaming.
+        # If this script is being run by controller.py, it will be started
+        # again, in the same process, when that happens.
         if self.count > self.total_tweets:
             return False
         if (self.count % 1000) == 0:
-            print 'count is: %s at %s' % (self.count, datetime.datetime.now())
+            print ('count is: %s at %s (published: %s, queued: %s, '
+                   'blocked: %s, errors: %s)' % (
+                           self.count, datetime.datetime.now(),
+                           self.publisher.published,
+                           self.publisher.tweets.qsize(),
+                           self.publisher.blocked, self.publisher.errors))
         return True
 
     def on_error(self, status):
         print status
 
 
-if __name__ == '__main__':
+def main():
+    """Stream tweets until total_tweets have been read, or the stream ends.
+    Can be run again in the same process.
+    """
     print '....'
+    metrics.serve()
     listener = StdOutListener()
     auth = OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
@@ -98,15 +257,24 @@ if __name__ == '__main__':
     # will sample the twitter public stream. If not 'sample', instead track
     # the given set of keywords.
     # This environment var is set in the 'twitter-stream.yaml' file.
-    if os.environ['TWSTREAMMODE'] == 'sample':
-        stream.sample()
-    else:
-        stream.filter(
-                track=['bigdata', 'kubernetes', 'bigquery', 'docker', 'google',
-                       'googlecloud', 'golang', 'dataflow',
-                       'containers', 'appengine', 'gcp', 'compute',
-                       'scalability', 'gigaom', 'news', 'tech', 'apple',
-                       'amazon', 'cluster', 'distributed', 'computing',
-                       'cloud', 'android', 'mobile', 'ios', 'iphone',
-                       'python', 'recode', 'techcrunch', 'timoreilly']
-                )
+    try:
+        if os.environ['TWSTREAMMODE'] == 'sample':
+            stream.sample()
+        else:
+            stream.filter(
+                    track=['bigdata', 'kubernetes', 'bigquery', 'docker',
+                           'google', 'googlecloud', 'golang', 'dataflow',
+                           'containers', 'appengine', 'gcp', 'compute',
+                           'scalability', 'gigaom', 'news', 'tech', 'apple',
+                           'amazon', 'cluster', 'distributed', 'computing',
+                           'cloud', 'android', 'mobile', 'ios', 'iphone',
+                           'python', 'recode', 'techcrunch', 'timoreilly']
+                    )
+    finally:
+        # Send what's buffered, and stop the background threads, even if
+        # the stream failed.
+        listener.publisher.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,39 +19,350 @@ data to BigQuery
 
 import collections
 import datetime
+import gzip
+import importlib
+import json
+import os
+import Queue
+import random
+import re
+import struct
+import tempfile
+import threading
 import time
+import zlib
 
 from apiclient import discovery
+from apiclient import errors
+from apiclient import http
+from apiclient import model
 import dateutil.parser
 import httplib2
 from oauth2client.client import GoogleCredentials
 
+import metrics
+
 SCOPES = ['https://www.googleapis.com/auth/bigquery',
           'https://www.googleapis.com/auth/pubsub']
 NUM_RETRIES = 3
+# How many times to try inserting a row into BigQuery, and the delays (in
+# seconds) to back off between tries.
+INSERT_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Errors reported by BigQuery that are worth retrying, for rows, requests
+# and load jobs. 'stopped' means the row was fine, but wasn't inserted
+# because of another row's error. Rate and quota limits come as a 403.
+RETRYABLE_REASONS = frozenset(['stopped', 'timeout', 'backendError',
+                               'internalError', 'rateLimitExceeded',
+                               'quotaExceeded'])
+# How often to check whether a BigQuery load job has finished, in seconds.
+LOAD_POLL_INTERVAL = 5
+# How often to check the spill log for rows to replay, and how long to wait
+# before trying again when BigQuery still fails them, in seconds.
+SPILL_POLL_INTERVAL = 1
+SPILL_RETRY_INTERVAL = 30
+# A copy of bigquery-setup/schema.json is added to the image next to this file.
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'schema.json')
+# The number of recently parsed 'created_at' strings to remember.
+TIMESTAMP_CACHE_SIZE = 10000
+# The number of shapes of tweets (sets of fields not in the schema) to
+# remember, once checked for new fields.
+SCHEMA_SHAPE_CACHE_SIZE = 10000
+# How long to wait after adding fields to a table's schema before sending
+# rows with them, while the change reaches streaming inserts, in seconds.
+SCHEMA_SETTLE_TIME = 60
+# BigQuery column names.
+_FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]{0,127}$')
+# The JSON libraries to try, fastest first, when JSON_CODEC is 'auto'.
+JSON_CODECS = ('ujson', 'simplejson', 'json')
+# Frames in the Twitter stream that aren't tweets. They're recognized by
+# their first key, and dropped without being parsed.
+CONTROL_FRAME_PREFIXES = ('{"delete"', '{"limit"')
+# Queue elements written by pack_rows() start with this header, which can't
+# start a stream frame. It's followed by a zlib-compressed JSON list of rows
+# that have already been projected onto the schema.
+PACKED_HEADER = '\x00TWZ1'
+# The zlib compression level of packed elements, from 1 (fastest) to 9.
+PACK_LEVEL = int(os.environ.get('PACK_LEVEL', 6))
+# API discovery documents are read from DISCOVERY_DIR, where the Docker image
+# stores them when it's built, rather than fetched every time a client is
+# built. A missing document is fetched once, and saved there.
+DISCOVERY_DIR = os.environ.get(
+        'DISCOVERY_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery'))
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+
+
+def load_codec(name):
+    """Import the named JSON library, or the fastest installed one if name is
+    'auto'. Falls back to the standard json module.
+    """
+    names = JSON_CODECS if name == 'auto' else (name,)
+    for module_name in names:
+        try:
+            return importlib.import_module(module_name)
+        except ImportError:
+            pass
+    print 'JSON codec %s is not installed: using json' % name
+    return json
+
+# The JSON library used to decode tweets and to encode API requests.
+codec = load_codec(os.environ.get('JSON_CODEC', 'auto'))
+
+
+def loads(data):
+    """Decode a JSON string with the configured codec."""
+    return codec.loads(data)
+
+
+def dumps(obj):
+    """Encode an object as JSON with the configured codec."""
+    return codec.dumps(obj)
+
+
+def is_control_frame(data):
+    """Whether the raw stream data is a 'delete' or 'limit' notice rather
+    than a tweet. This only looks at the start of the string, so anything
+    it misses still has to be checked after parsing.
+    """
+    return data.startswith(CONTROL_FRAME_PREFIXES)
+
+
+def is_packed(data):
+    """Whether a queue element is a packed batch of rows, rather than a raw
+    stream frame."""
+    return data.startswith(PACKED_HEADER)
+
+
+def pack_rows(rows, level=PACK_LEVEL):
+    """Pack a list of rows into a single compressed queue element."""
+    return PACKED_HEADER + zlib.compress(dumps(rows), level)
+
+
+def unpack_rows(data):
+    """Unpack a queue element written by pack_rows(). Returns the rows, and
+    the size of their JSON encoding."""
+    payload = zlib.decompress(buffer(data, len(PACKED_HEADER)))
+    return loads(payload), len(payload)
+
+
+def pack_frames(frames, transform, level=PACK_LEVEL):
+    """Project raw stream frames onto the schema with transform, and pack
+    the rows into a single queue element. Frames that aren't tweets, or
+    can't be parsed, are dropped. Returns None if no rows are left.
+    """
+    rows = []
+    for frame in frames:
+        if is_control_frame(frame):
+            continue
+        try:
+            tweet = loads(frame)
+        except Exception, e:
+            print 'Dropping invalid frame: %s' % e
+            continue
+        if 'delete' in tweet or 'limit' in tweet:
+            continue
+        rows.append(transform(tweet))
+    if not rows:
+        return None
+    return pack_rows(rows, level)
+
+
+class CodecJsonModel(model.JsonModel):
+    """Serializes API requests and responses with the configured codec,
+    instead of with the standard json module.
+    """
+
+    def serialize(self, body_value):
+        if (isinstance(body_value, dict) and 'data' not in body_value and
+                self._data_wrapper):
+            body_value = {'data': body_value}
+        return dumps(body_value)
+
+    def deserialize(self, content):
+        body = loads(content)
+        if self._data_wrapper and isinstance(body, dict) and 'data' in body:
+            body = body['data']
+        return body
+
+
+# The discovery documents that have been loaded, by (api, version).
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+# The credentials shared by all the clients, once they've been looked up.
+_credentials = None
+
+
+def get_discovery_document(api, version):
+    """Return the discovery document for an API, as a JSON string.
 
+    The document is read from DISCOVERY_DIR, or fetched and saved there if
+    it's missing, and then kept in memory.
+    """
+    with _discovery_lock:
+        if (api, version) not in _discovery_documents:
+            _discovery_documents[api, version] = _load_discovery_document(
+                    api, version)
+        return _discovery_documents[api, version]
+
+
+def _load_discovery_document(api, version):
+    path = os.path.join(DISCOVERY_DIR, '%s.%s.json' % (api, version))
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        pass
+    uri = DISCOVERY_URL % (api, version)
+    resp, content = httplib2.Http().request(uri)
+    if resp.status >= 400:
+        raise errors.HttpError(resp, content, uri=uri)
+    try:
+        if not os.path.isdir(DISCOVERY_DIR):
+            os.makedirs(DISCOVERY_DIR)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        print 'Could not save discovery document %s: %s' % (path, e)
+    return content
+
+
+def build_client(api, version, credentials):
+    """Build a client for an API from its stored discovery document. Each
+    client has its own httplib2.Http, which keeps its connections open
+    between requests.
+    """
+    http = httplib2.Http()
+    credentials.authorize(http)
+    return discovery.build_from_document(
+            loads(get_discovery_document(api, version)), http=http,
+            model=CodecJsonModel())
 
 
 def get_credentials():
-    """Get the Google credentials needed to access our services."""
-    credentials = GoogleCredentials.get_application_default()
-    if credentials.create_scoped_required():
-            credentials = credentials.create_scoped(SCOPES)
-    return credentials
+    """Get the Google credentials needed to access our services. They're
+    looked up once, and shared by all the clients.
+    """
+    global _credentials
+    if _credentials is None:
+        credentials = GoogleCredentials.get_application_default()
+        if credentials.create_scoped_required():
+                credentials = credentials.create_scoped(SCOPES)
+        _credentials = credentials
+    return _credentials
 
 
 def create_bigquery_client(credentials):
     """Build the bigquery client."""
-    http = httplib2.Http()
-    credentials.authorize(http)
-    return discovery.build('bigquery', 'v2', http=http)
+    return build_client('bigquery', 'v2', credentials)
 
 
 def create_pubsub_client(credentials):
     """Build the pubsub client."""
-    http = httplib2.Http()
-    credentials.authorize(http)
-    return discovery.build('pubsub', 'v1beta2', http=http)
+    return build_client('pubsub', 'v1beta2', credentials)
+
+
+# Sentinel for cache misses, since None is a legitimate cached value.
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A bounded cache that keeps recently used entries.
+
+    Entries live in two generations of plain dicts, so a lookup costs a dict
+    access rather than the bookkeeping of an exact LRU. When the newer
+    generation fills up it becomes the older one, and the old one is
+    discarded; entries read from the older generation are moved back into
+    the newer one, so anything used recently survives the rotation.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = max(2, maxsize)
+        self._new = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    def __contains__(self, key):
+        return key in self._new or key in self._old
+
+    def get(self, key, default=None):
+        value = self._new.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self._old.pop(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self._new) >= self.maxsize // 2:
+            self._old = self._new
+            self._new = {}
+        self._new[key] = value
+
+    def pop(self, key, default=None):
+        value = self._new.pop(key, _MISSING)
+        if value is _MISSING:
+            value = self._old.pop(key, default)
+        return value
+
+
+class DuplicateFilter(object):
+    """Remembers the ids of recently seen tweets, so that copies of them
+    (e.g. redelivered after a consumer restart) can be dropped before they
+    are sent to BigQuery."""
+
+    def __init__(self, size):
+        self.seen = LRUCache(size)
+        self.duplicates = 0
+
+    def is_duplicate(self, key):
+        """Returns True if key was seen recently, and records it if not."""
+        if key is None:
+            return False
+        if self.seen.get(key) is not None:
+            self.duplicates += 1
+            return True
+        self.seen[key] = True
+        return False
+
+    def forget(self, key):
+        """Forget a key, so that its next copy isn't dropped: e.g. when
+        its row couldn't be inserted, and it will be redelivered."""
+        self.seen.pop(key)
+
+
+class Element(object):
+    """A queue element (a Redis list item, or a Pub/Sub message) whose rows
+    are being written to BigQuery.
+
+    A packed element holds many rows, which can end up in different
+    batches, so it's only finished once all of them have been handled, and
+    it has failed if any of them failed.
+    """
+
+    __slots__ = ('key', 'pending', 'failed')
+    _lock = threading.Lock()
+
+    def __init__(self, key, rows=1):
+        self.key = key
+        self.pending = rows
+        self.failed = False
+
+    def finish_row(self, failed=False):
+        """Record that one of the element's rows has been handled. Returns
+        True if it was the last one."""
+        with self._lock:
+            self.pending -= 1
+            self.failed = self.failed or failed
+            return self.pending == 0
 
 
 def flatten(lst):
@@ -74,7 +385,7 @@ def cleanup(data):
                 # flatten list
                 newdict[k] = list(flatten(v))
             elif k == 'created_at' and v:
-                newdict[k] = str(dateutil.parser.parse(v))
+                newdict[k] = parse_timestamp(v)
             # temporarily, ignore some fields not supported by the
             # current BQ schema.
             # TODO: update BigQuery schema
@@ -101,21 +412,1279 @@ def cleanup(data):
         return data
 
 
-def bq_data_insert(bigquery, project_id, dataset, table, tweets):
-    """Insert a list of tweets into the given BigQuery table."""
+_MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05',
+           'Jun': '06', 'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10',
+           'Nov': '11', 'Dec': '12'}
+
+
+def _parse_twitter_time(value):
+    """Parse the fixed Twitter format, e.g. 'Wed Oct 10 20:19:24 +0000 2018'.
+
+    Returns None if the value is not in that format.
+    """
+    parts = value.split(' ')
+    if len(parts) != 6:
+        return None
+    _, month, day, clock, offset, year = parts
+    month = _MONTHS.get(month)
+    if (month is None or len(day) != 2 or not day.isdigit() or
+            len(clock) != 8 or clock[2] != ':' or clock[5] != ':' or
+            not (clock[:2] + clock[3:5] + clock[6:]).isdigit() or
+            len(offset) != 5 or offset[0] not in '+-' or
+            not offset[1:].isdigit() or len(year) != 4 or
+            not year.isdigit()):
+        return None
+    return '%s-%s-%s %s%s:%s' % (year, month, day, clock, offset[:3],
+                                 offset[3:])
+
+
+_timestamp_cache = LRUCache(TIMESTAMP_CACHE_SIZE)
+
+
+def parse_timestamp(value):
+    """Convert a tweet 'created_at' string into a BigQuery TIMESTAMP string.
+
+    The result is the same as str(dateutil.parser.parse(value)), but the
+    Twitter format is parsed directly, with dateutil only used for values
+    in any other format. Results are cached, since many tweets share the
+    same second and retweets repeat the original user's 'created_at'.
+    """
+    result = _timestamp_cache.get(value)
+    if result is None:
+        result = _parse_twitter_time(value)
+        if result is None:
+            result = str(dateutil.parser.parse(value))
+        _timestamp_cache[value] = result
+    return result
+
+
+def write_stats(path, stats):
+    """Replace the file at path with the stats dict, as JSON. The file is
+    renamed into place, so readers never see a partly written file.
+    """
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(stats, f)
+    os.rename(tmp_path, path)
+
+
+def read_stats(path):
+    """Read a stats file written by write_stats(), if there is one."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def add_stats(totals, stats):
+    """Add the counters in the stats dict to totals, and return totals."""
+    for name, value in stats.iteritems():
+        totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def load_schema(path=SCHEMA_FILE):
+    """Load a BigQuery table schema (a list of field definitions)."""
+    with open(path) as f:
+        return json.load(f)
+
+
+# Marks a field that is not in the schema, and so is dropped.
+_DROP = object()
+
+
+def _keep_list(v):
+    """Keep a repeated scalar field, flattening any nested lists."""
+    if isinstance(v, list):
+        return list(flatten(v)) or None
+    return None
+
+
+def _compile_field(field, on_unknown=None, path=()):
+    """Returns the converter for a single schema field.
+
+    A converter of None means a scalar value is kept as is. Otherwise the
+    converter is called with the raw value, and returns the value to store,
+    or None if the field should be dropped from the row.
+    """
+    if field['type'] == 'RECORD':
+        project = _compile_record(field['fields'], on_unknown,
+                                  path + (field['name'],))
+        if field.get('mode') == 'REPEATED':
+            def convert(v):
+                if not isinstance(v, list):
+                    return None
+                rows = [project(item) for item in v if isinstance(item, dict)]
+                return [row for row in rows if row] or None
+        else:
+            def convert(v):
+                if not isinstance(v, dict):
+                    return None
+                return project(v) or None
+        return convert
+    if field['type'] == 'TIMESTAMP':
+        return parse_timestamp
+    if field.get('mode') == 'REPEATED':
+        return _keep_list
+    return None
+
+
+def _compile_record(fields, on_unknown=None, path=()):
+    """Returns a function that projects a dict onto the given schema fields.
+
+    If given, on_unknown is called with the path of the record (the names
+    of the fields it's in), the dict, and the keys of the fields it has
+    that the schema doesn't, whenever there are any.
+    """
+    plan = dict((field['name'], _compile_field(field, on_unknown, path))
+                for field in fields)
+    get = plan.get
+
+    def project(data):
+        row = {}
+        unknown = None
+        for k, v in data.iteritems():
+            if v is None or v == '':
+                continue
+            convert = get(k, _DROP)
+            if convert is _DROP:
+                if on_unknown is not None:
+                    if unknown is None:
+                        unknown = []
+                    unknown.append(k)
+                continue
+            if convert is None:
+                # Like cleanup(), drop objects and arrays (such as a place's
+                # empty 'attributes') that a scalar column can't hold.
+                if isinstance(v, (dict, list)):
+                    continue
+            else:
+                v = convert(v)
+                if v is None:
+                    continue
+            row[k] = v
+        if unknown is not None:
+            on_unknown(path, data, unknown)
+        return row
+    return project
+
+
+def compile_schema(fields):
+    """Compile a BigQuery schema into a function that transforms tweets.
+
+    This is a faster replacement for cleanup(): the per-field plan is built
+    once, so each tweet is projected in a single pass, keeping only the
+    fields the table knows about, converting timestamps and flattening
+    repeated fields along the way.
+    """
+    return _compile_record(fields)
+
+
+def _infer_field(name, value):
+    """Returns a schema field for a value of a field the schema doesn't
+    have: NULLABLE, or REPEATED for a list. Returns None if the name can't
+    be a column name, or the type can't be told from the value, e.g. for an
+    empty list.
+    """
+    if not _FIELD_NAME.match(name):
+        return None
+    mode = 'NULLABLE'
+    if isinstance(value, list):
+        values = [v for v in value if v is not None]
+        if not values or isinstance(values[0], list):
+            return None
+        mode = 'REPEATED'
+        value = values[0]
+    if isinstance(value, bool):
+        field_type = 'BOOLEAN'
+    elif isinstance(value, (int, long)):
+        field_type = 'INTEGER'
+    elif isinstance(value, float):
+        field_type = 'FLOAT'
+    elif isinstance(value, basestring):
+        field_type = 'STRING'
+    elif isinstance(value, dict):
+        fields = [_infer_field(k, v) for k, v in sorted(value.iteritems())
+                  if v is not None]
+        fields = [field for field in fields if field is not None]
+        if not fields:
+            return None
+        return {'name': name, 'type': 'RECORD', 'mode': mode,
+                'fields': fields}
+    else:
+        return None
+    return {'name': name, 'type': field_type, 'mode': mode}
+
+
+def _field_paths(fields, path=()):
+    """Yield the (path of its record, name) of every field in a schema."""
+    for field in fields:
+        yield path, field['name']
+        if field['type'] == 'RECORD':
+            for item in _field_paths(field['fields'],
+                                     path + (field['name'],)):
+                yield item
+
+
+def _add_fields(fields, pending):
+    """Returns a copy of the schema fields with the pending fields added,
+    and the number of fields added. pending maps the path of a record (a
+    tuple of field names, () for the top level) to the fields to add to it.
+    Fields that are already there are left alone.
+    """
+    fields = json.loads(json.dumps(fields))
+    added = 0
+    for path, new_fields in pending.iteritems():
+        record = fields
+        for name in path:
+            parent = [field for field in record if field['name'] == name and
+                      field['type'] == 'RECORD']
+            if not parent:
+                record = None
+                break
+            record = parent[0]['fields']
+        if record is None:
+            continue
+        names = set(field['name'] for field in record)
+        for field in new_fields:
+            if field['name'] not in names:
+                record.append(field)
+                names.add(field['name'])
+                added += 1
+    return fields, added
+
+
+SCHEMA_FIELDS_ADDED = metrics.counter(
+        'bigquery_schema_fields_added_total',
+        'Fields added to the BigQuery table schema.')
+
+
+class SchemaRegistry(object):
+    """Keeps a table's schema, and the transformer compiled from it.
+
+    transform() projects tweets onto the schema, like the function returned
+    by compile_schema(). Once start() is called, fields that tweets have and
+    the schema doesn't are noticed as they're dropped, and added to the
+    table's schema every interval seconds with tables.patch, rather than
+    being lost. Tweets are only checked once per shape: the set of unknown
+    fields found in a record is cached, so tweets shaped like earlier ones
+    cost no more than the projection.
+
+    Each update also reads the table's schema back, picking up fields added
+    by other consumers. Rows with the new fields are only sent
+    SCHEMA_SETTLE_TIME seconds after the patch, once streaming inserts see
+    them.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._project = _compile_record(fields)
+        # The fields waiting to be added, by the path of their record, the
+        # (path, name) of every field found since the schema changed, and
+        # those of the fields in the schema.
+        self._pending = {}
+        self._found = set()
+        self._known = set(_field_paths(fields))
+        self._shapes = LRUCache(SCHEMA_SHAPE_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def transform(self, data):
+        return self._project(data)
+
+    def start(self, clients, project_id, dataset, table, interval=60):
+        """Start adding new fields to the table, unless it's already
+        started. The updates use a client from the ClientPool clients."""
+        if self._thread is not None:
+            return
+        self.clients = clients
+        self.project_id = project_id
+        self.dataset = dataset
+        self.table = table
+        self.interval = interval
+        self._project = _compile_record(self.fields, self._notice)
+        metrics.gauge('bigquery_schema_pending_fields',
+                      'New fields waiting to be added to the table schema.',
+                      lambda: sum(len(fields)
+                                  for fields in self._pending.values()))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _notice(self, path, data, keys):
+        """Called with a record that had fields not in the schema."""
+        shape = (path, frozenset(keys))
+        if shape in self._shapes:
+            return
+        known = True
+        with self._lock:
+            for key in keys:
+                # A tweet projected while the schema changed can have
+                # fields that were just added.
+                if (path, key) in self._found or (path, key) in self._known:
+                    continue
+                field = _infer_field(key, data[key])
+                if field is None:
+                    # Try again when a value shows what type it is.
+                    known = False
+                else:
+                    print 'New field in tweets: %s' % '.'.join(path + (key,))
+                    self._pending.setdefault(
+                            path, collections.OrderedDict())[key] = field
+                    self._found.add((path, key))
+        if known:
+            self._shapes[shape] = True
+
+    def _run(self):
+        bigquery = self.clients.acquire()
+        try:
+            while True:
+                try:
+                    self._update(bigquery)
+                except Exception, e:
+                    print 'Problem updating the table schema: %s' % e
+                time.sleep(self.interval)
+        finally:
+            self.clients.release(bigquery)
+
+    def _update(self, bigquery):
+        table = bigquery.tables().get(
+                projectId=self.project_id, datasetId=self.dataset,
+                tableId=self.table).execute(num_retries=NUM_RETRIES)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        fields, added = _add_fields(
+                table['schema']['fields'],
+                dict((path, new_fields.values())
+                     for path, new_fields in pending.iteritems()))
+        if added:
+            try:
+                table = bigquery.tables().patch(
+                        projectId=self.project_id, datasetId=self.dataset,
+                        tableId=self.table,
+                        body={'schema': {'fields': fields}}).execute(
+                                num_retries=NUM_RETRIES)
+            except Exception:
+                # Keep the fields, to try them again next time.
+                with self._lock:
+                    for path, new_fields in pending.iteritems():
+                        for key, field in new_fields.iteritems():
+                            self._pending.setdefault(
+                                    path, collections.OrderedDict()
+                                    ).setdefault(key, field)
+                raise
+            SCHEMA_FIELDS_ADDED.inc(added)
+            print 'Added %s fields to the schema of %s' % (added, self.table)
+            time.sleep(SCHEMA_SETTLE_TIME)
+        fields = table['schema']['fields']
+        if fields != self.fields:
+            self.fields = fields
+            self._known = set(_field_paths(fields))
+            self._project = _compile_record(fields, self._notice)
+            self._shapes = LRUCache(SCHEMA_SHAPE_CACHE_SIZE)
+            with self._lock:
+                self._found = set()
+
+
+def _table_suffix(value):
+    """Make a value safe to append to a table name: letters, digits and '_'.
+    """
+    return ''.join(c if c.isalnum() and ord(c) < 128 else '_'
+                   for c in value.lower())
+
+
+def make_router(mode, table, keywords=()):
+    """Returns a function that picks the destination of a row, for a
+    Batcher, or None if mode is 'none' and all rows go to table.
+
+    A destination is a (table, template suffix) pair, as taken by
+    BigQueryInserter.insert(). In mode 'day', rows go to the partition of
+    table for the UTC day they were created on, e.g. 'tweets$20181010'. In
+    mode 'lang', they go to a table per language, e.g. 'tweets_en', and in
+    mode 'keyword' to a table per keyword, the first of keywords found in
+    their text, with the rows that match none of them going to table.
+    Tables per language or keyword are created from table, with its schema,
+    the first time rows are inserted into them.
+    """
+    if mode == 'none':
+        return None
+    if mode == 'day':
+        def route(row):
+            created_at = row.get('created_at')
+            if not created_at:
+                return table, None
+            # A BigQuery timestamp string, e.g. '2018-10-10 20:19:24+00:00'.
+            return '%s$%s' % (table, created_at[:10].replace('-', '')), None
+    elif mode == 'lang':
+        def route(row):
+            lang = row.get('lang')
+            if not lang:
+                return table, None
+            return table, '_' + _table_suffix(lang)
+    elif mode == 'keyword':
+        keywords = [keyword.strip() for keyword in keywords]
+        keywords = [(keyword.lower(), '_' + _table_suffix(keyword))
+                    for keyword in keywords if keyword]
+
+        def route(row):
+            text = (row.get('text') or '').lower()
+            for keyword, suffix in keywords:
+                if keyword in text:
+                    return table, suffix
+            return table, None
+    else:
+        raise ValueError('Unknown routing mode: %r' % mode)
+    return route
+
+
+def _insert_row(item):
+    """Wrap a row for insertAll, using the tweet id as its insertId, so that
+    BigQuery drops copies of it that are sent again."""
+    row = {"json": item}
+    insert_id = item.get('id_str')
+    if insert_id:
+        row["insertId"] = insert_id
+    return row
+
+
+def _is_retryable(row_errors):
+    return all(error.get('reason') in RETRYABLE_REASONS
+               for error in row_errors)
+
+
+def _is_retryable_http(e):
+    """Whether a request that failed with the HttpError e is worth trying
+    again: a server error, a 429, or an error with retryable reasons, such
+    as a 403 for a rate limit.
+    """
+    status = e.resp.status
+    if status >= 500 or status == 429:
+        return True
     try:
-        rowlist = []
+        details = json.loads(e.content)['error']['errors']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return bool(details) and _is_retryable(details)
+
+
+def _backoff(attempt):
+    """Sleep before the next try, with exponential backoff and full jitter."""
+    time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+
+def bq_data_insert(bigquery, project_id, dataset, table, tweets,
+                   dead_letter=None, attempts=INSERT_ATTEMPTS,
+                   template_suffix=None):
+    """Insert a list of tweets into the given BigQuery table.
+
+    If template_suffix is given, the tweets go to the table named table plus
+    template_suffix instead, which BigQuery creates from table if needed.
+
+    Rows that fail with a retryable error are tried again on their own, with
+    exponential backoff. Rows that can never be inserted are passed to
+    dead_letter, if given, as a list of {'row': ..., 'errors': ...} dicts.
+    Returns the rows that still couldn't be inserted after all the tries.
+    """
+    pending = tweets
+    for attempt in range(attempts):
+        if attempt:
+            _backoff(attempt)
+        rejected = []
         # Generate the data that will be sent to BigQuery
-        for item in tweets:
-            item_row = {"json": item}
-            rowlist.append(item_row)
-        body = {"rows": rowlist}
-        # Try the insertion.
-        response = bigquery.tabledata().insertAll(
-                projectId=project_id, datasetId=dataset,
-                tableId=table, body=body).execute(num_retries=NUM_RETRIES)
-        # print "streaming response: %s %s" % (datetime.datetime.now(), response)
-        return response
-        # TODO: 'invalid field' errors can be detected here.
-    except Exception, e1:
-        print "Giving up: %s" % e1
+        body = {"rows": [_insert_row(item) for item in pending]}
+        if template_suffix:
+            body["templateSuffix"] = template_suffix
+        try:
+            # Try the insertion.
+            response = bigquery.tabledata().insertAll(
+                    projectId=project_id, datasetId=dataset,
+                    tableId=table, body=body).execute(num_retries=NUM_RETRIES)
+        except errors.HttpError, e:
+            if _is_retryable_http(e):
+                print "Retrying insert: %s" % e
+                continue
+            # The whole request was rejected, e.g. because it was too large.
+            rejected = [{'row': item, 'errors': [{'message': str(e)}]}
+                        for item in pending]
+            pending = []
+        except Exception, e1:
+            print "Retrying insert: %s" % e1
+            continue
+        else:
+            retry = []
+            for insert_error in response.get('insertErrors', []):
+                item = pending[insert_error['index']]
+                row_errors = insert_error.get('errors', [])
+                if _is_retryable(row_errors):
+                    retry.append(item)
+                else:
+                    rejected.append({'row': item, 'errors': row_errors})
+            pending = retry
+        if rejected:
+            print "Rejected %s rows: %s" % (len(rejected),
+                                            rejected[0]['errors'])
+            if dead_letter is not None:
+                dead_letter(rejected)
+        if not pending:
+            return []
+    print "Giving up on %s rows" % len(pending)
+    return pending
+
+
+class ClientPool(object):
+    """Keeps API clients for reuse, so that a pipeline that is restarted in
+    the same process doesn't have to build them again.
+
+    A client is only used by one thread at a time, since httplib2
+    connections can't be shared between threads: threads acquire() a client,
+    which is built with factory if none is free, and release() it when
+    they're done with it.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._clients:
+                return self._clients.pop()
+        return self.factory()
+
+    def release(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+
+class SpillLog(object):
+    """An append-only log of batches of rows on local disk, kept in
+    segment files in directory, for rows that couldn't be inserted into
+    BigQuery yet.
+
+    Each batch is a record: its length and CRC32 checksum, then its rows as
+    JSON, along with their destination if they have one (see
+    BigQueryInserter.insert()). A segment is closed once it holds
+    segment_bytes, or when it's the oldest one and is taken for replay.
+    append() refuses batches that would take the log over max_bytes.
+    Segments left over from an earlier run are replayed too.
+    """
+
+    _HEADER = struct.Struct('>II')
+
+    def __init__(self, directory, max_bytes=1000000000,
+                 segment_bytes=16000000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        # Records that were skipped because they were damaged.
+        self.corrupt = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The closed segments, oldest first, and the size of each segment.
+        self._closed = []
+        self._sizes = {}
+        names = sorted(name for name in os.listdir(directory)
+                       if name.endswith('.spill'))
+        for name in names:
+            path = os.path.join(directory, name)
+            self._closed.append(path)
+            self._sizes[path] = os.path.getsize(path)
+        self._next = int(names[-1].split('.')[0]) + 1 if names else 0
+        metrics.gauge('bigquery_spill_bytes',
+                      'Bytes of rows waiting in the spill log.',
+                      lambda: self.size)
+
+    @property
+    def size(self):
+        return sum(self._sizes.values())
+
+    def append(self, rows, destination=None):
+        """Write a batch of rows to the log, and flush it to disk. Returns
+        False if the log is full."""
+        if destination is None:
+            data = dumps(rows)
+        else:
+            data = dumps({'destination': destination, 'rows': rows})
+        record = self._HEADER.pack(len(data),
+                                   zlib.crc32(data) & 0xffffffff) + data
+        with self._lock:
+            if self.size + len(record) > self.max_bytes:
+                return False
+            if self._file is None:
+                path = os.path.join(self.directory,
+                                    '%012d.spill' % self._next)
+                self._next += 1
+                self._file = open(path, 'ab')
+                self._sizes[path] = 0
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._sizes[self._file.name] += len(record)
+            if self._sizes[self._file.name] >= self.segment_bytes:
+                self._close_segment()
+            return True
+
+    def oldest(self):
+        """Returns the path of the oldest segment, closing the segment being
+        written if there's no other, or None if the log is empty."""
+        with self._lock:
+            if not self._closed and self._file is not None:
+                self._close_segment()
+            return self._closed[0] if self._closed else None
+
+    def read(self, path, offset=0):
+        """Yield the batches of rows in a closed segment that start at or
+        after offset, as (rows, destination, offset of the next record).
+        Stops at the first damaged record, since what follows it can't be
+        trusted."""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self._HEADER.size)
+                if not header:
+                    return
+                data = ''
+                if len(header) == self._HEADER.size:
+                    length, checksum = self._HEADER.unpack(header)
+                    data = f.read(length)
+                if (len(header) < self._HEADER.size or len(data) < length or
+                        zlib.crc32(data) & 0xffffffff != checksum):
+                    print 'Skipping damaged records in %s' % path
+                    self.corrupt += 1
+                    return
+                batch = loads(data)
+                if isinstance(batch, dict):
+                    yield (batch['rows'], tuple(batch['destination']),
+                           f.tell())
+                else:
+                    yield batch, None, f.tell()
+
+    def remove(self, path):
+        """Delete a segment once all its rows have been replayed."""
+        with self._lock:
+            os.remove(path)
+            self._closed.remove(path)
+            del self._sizes[path]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._close_segment()
+
+    def _close_segment(self):
+        self._file.close()
+        self._closed.append(self._file.name)
+        self._file = None
+
+
+INSERT_LATENCY = metrics.histogram(
+        'bigquery_insert_latency_seconds',
+        'Time taken to insert a batch into BigQuery, including retries.')
+BATCH_ROWS = metrics.histogram(
+        'bigquery_batch_rows', 'Rows per batch inserted into BigQuery.',
+        metrics.SIZE_BUCKETS)
+ROWS_INSERTED, ROWS_REJECTED, ROWS_FAILED = [
+        metrics.counter('bigquery_rows_total',
+                        'Rows sent to BigQuery, by result.', result=result)
+        for result in ('inserted', 'rejected', 'failed')]
+ROWS_SPILLED = metrics.counter('bigquery_spilled_rows_total',
+                               'Rows written to the spill log.')
+ROWS_REPLAYED = metrics.counter(
+        'bigquery_replayed_rows_total',
+        'Rows from the spill log inserted into BigQuery.')
+
+
+class BigQueryInserter(object):
+    """Streams batches of rows into a BigQuery table from a pool of threads.
+
+    Each worker thread takes its own BigQuery client from the ClientPool
+    clients. Batches wait in a bounded queue, so insert() blocks when the
+    workers fall behind.
+
+    If spill is a SpillLog, rows that still fail after all their tries are
+    written to it, as are batches that wait more than spill_after seconds
+    for room in the queue; they count as handled. Another thread replays
+    the log into BigQuery, in batches of up to replay_rows rows, while the
+    workers keep up.
+    """
+
+    def __init__(self, clients, project_id, dataset, table,
+                 workers=4, queue_size=8, on_latency=None, dead_letter=None,
+                 spill=None, spill_after=10, replay_rows=500):
+        self.clients = clients
+        # If set, called with the number of rows and the duration of each
+        # insertAll request.
+        self.on_latency = on_latency
+        self.dead_letter = dead_letter
+        self.project_id = project_id
+        self.dataset = dataset
+        self.table = table
+        self.queue = Queue.Queue(queue_size)
+        self.batches = 0
+        self.rows = 0
+        self.rejected = 0
+        self.failed = 0
+        self.spill = spill
+        self.spill_after = spill_after
+        self.replay_rows = replay_rows
+        self.spilled = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # How far into each spill log segment has been replayed.
+        self._replay_offsets = {}
+        metrics.gauge('bigquery_insert_queue_batches',
+                      'Batches waiting for a BigQuery insert worker.',
+                      self.queue.qsize)
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._replayer = None
+        if spill is not None:
+            self._replayer = threading.Thread(target=self._replay)
+            self._replayer.daemon = True
+            self._replayer.start()
+
+    def insert(self, rows, callback=None, destination=None):
+        """Queue a batch of rows for insertion.
+
+        If given, callback is called from the worker thread with the rows
+        that couldn't be inserted (see bq_data_insert), if any. destination
+        is a (table, template suffix) pair, from make_router(), for rows
+        that don't go to this inserter's table.
+        """
+        item = (rows, callback, destination)
+        if self.spill is not None:
+            try:
+                self.queue.put(item, timeout=self.spill_after)
+                return
+            except Queue.Full:
+                if self._spill(rows, destination):
+                    if callback is not None:
+                        callback([])
+                    return
+        self.queue.put(item)
+
+    def close(self):
+        """Wait for the queued batches to be inserted, and stop the workers.
+        Rows left in the spill log are replayed by the next inserter."""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._closed.set()
+        if self._replayer is not None:
+            self._replayer.join()
+            self.spill.close()
+
+    def _spill(self, rows, destination=None):
+        """Write rows to the spill log. Returns False if it's full."""
+        if not self.spill.append(rows, destination):
+            return False
+        ROWS_SPILLED.inc(len(rows))
+        with self._lock:
+            self.spilled += len(rows)
+        return True
+
+    def _run(self):
+        bigquery = self.clients.acquire()
+        try:
+            self._insert_batches(bigquery)
+        finally:
+            self.clients.release(bigquery)
+
+    def _insert_batches(self, bigquery):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            rows, callback, destination = item
+            table, suffix = destination or (self.table, None)
+            rejected = []
+            start = time.time()
+            failed = bq_data_insert(bigquery, self.project_id, self.dataset,
+                                    table, rows, rejected.extend,
+                                    template_suffix=suffix)
+            latency = time.time() - start
+            spilled = []
+            if (failed and self.spill is not None and
+                    self._spill(failed, destination)):
+                spilled, failed = failed, []
+            if self.on_latency is not None:
+                self.on_latency(len(rows), latency)
+            INSERT_LATENCY.observe(latency)
+            BATCH_ROWS.observe(len(rows))
+            inserted = len(rows) - len(rejected) - len(failed) - len(spilled)
+            ROWS_INSERTED.inc(inserted)
+            ROWS_REJECTED.inc(len(rejected))
+            ROWS_FAILED.inc(len(failed))
+            if rejected and self.dead_letter is not None:
+                try:
+                    self.dead_letter(rejected)
+                except Exception, e:
+                    print "Problem writing rejected rows: %s" % e
+            with self._lock:
+                self.batches += 1
+                self.rows += inserted
+                self.rejected += len(rejected)
+                self.failed += len(failed)
+            if callback is not None:
+                try:
+                    callback(failed)
+                except Exception, e:
+                    print "Problem handling inserted batch: %s" % e
+
+    def _replay(self):
+        bigquery = self.clients.acquire()
+        try:
+            while not self._closed.is_set():
+                path = self.spill.oldest()
+                # Leave BigQuery to new rows while the workers are busy.
+                if path is None or self.queue.qsize() > 0:
+                    self._closed.wait(SPILL_POLL_INTERVAL)
+                elif not self._replay_segment(bigquery, path):
+                    self._closed.wait(SPILL_RETRY_INTERVAL)
+        finally:
+            self.clients.release(bigquery)
+
+    def _replay_segment(self, bigquery, path):
+        """Insert the rows in a segment of the spill log, and delete it.
+        Returns False if some of them still couldn't be inserted; the
+        segment is then tried again, from where it went wrong. Consecutive
+        batches for the same destination are inserted together."""
+        offset = self._replay_offsets.get(path, 0)
+        rows = []
+        destination = None
+        for batch, batch_destination, end in self.spill.read(path, offset):
+            if rows and batch_destination != destination:
+                if not self._replay_rows(bigquery, rows, destination):
+                    return False
+                rows = []
+                self._replay_offsets[path] = offset
+            rows.extend(batch)
+            destination = batch_destination
+            offset = end
+            if len(rows) < self.replay_rows:
+                continue
+            if not self._replay_rows(bigquery, rows, destination):
+                return False
+            rows = []
+            self._replay_offsets[path] = end
+            if self._closed.is_set():
+                return True
+        if rows and not self._replay_rows(bigquery, rows, destination):
+            return False
+        self.spill.remove(path)
+        self._replay_offsets.pop(path, None)
+        return True
+
+    def _replay_rows(self, bigquery, rows, destination):
+        table, suffix = destination or (self.table, None)
+        rejected = []
+        failed = bq_data_insert(bigquery, self.project_id, self.dataset,
+                                table, rows, rejected.extend,
+                                template_suffix=suffix)
+        if failed:
+            return False
+        ROWS_INSERTED.inc(len(rows) - len(rejected))
+        ROWS_REPLAYED.inc(len(rows) - len(rejected))
+        ROWS_REJECTED.inc(len(rejected))
+        if rejected and self.dead_letter is not None:
+            try:
+                self.dead_letter(rejected)
+            except Exception, e:
+                print "Problem writing rejected rows: %s" % e
+        with self._lock:
+            self.rows += len(rows) - len(rejected)
+            self.rejected += len(rejected)
+        return True
+
+
+LOAD_LATENCY = metrics.histogram(
+        'bigquery_load_job_seconds',
+        'Time taken to load a file into BigQuery, including retries.',
+        (5, 10, 30, 60, 120, 300, 600, 1800))
+LOAD_FILE_ROWS = metrics.histogram(
+        'bigquery_load_file_rows', 'Rows per file loaded into BigQuery.',
+        (1000, 10000, 50000, 100000, 250000, 500000, 1000000))
+
+
+def _wait_for_job(bigquery, project_id, job):
+    """Poll a job until it's done, and return it, or None if it can't be
+    found. Polling errors are retried, on the same job: giving up on a job
+    that may still finish could load its rows twice.
+    """
+    while job['status']['state'] != 'DONE':
+        time.sleep(LOAD_POLL_INTERVAL)
+        try:
+            job = bigquery.jobs().get(
+                    projectId=project_id,
+                    jobId=job['jobReference']['jobId']).execute(
+                            num_retries=NUM_RETRIES)
+        except errors.HttpError, e:
+            if e.resp.status == 404:
+                return None
+            print "Problem checking load job: %s" % e
+        except Exception, e1:
+            print "Problem checking load job: %s" % e1
+    return job
+
+
+def bq_load_file(bigquery, project_id, dataset, table, path, schema,
+                 job_id, attempts=INSERT_ATTEMPTS):
+    """Load a gzipped newline-delimited JSON file into the given BigQuery
+    table with a load job, and wait for the job to finish.
+
+    Requests that fail are tried again, with exponential backoff, under the
+    same job id, so that the file is never loaded by two jobs. Only a job
+    that finished with a retryable error is submitted again under a new job
+    id. Returns None if the file was loaded, the job's error result if its
+    rows were rejected, or False if it still couldn't be loaded after all
+    the tries.
+    """
+    job_number = 0
+    for attempt in range(attempts):
+        if attempt:
+            _backoff(attempt)
+        body = {
+            'jobReference': {'projectId': project_id,
+                             'jobId': '%s-%d' % (job_id, job_number)},
+            'configuration': {'load': {
+                'destinationTable': {'projectId': project_id,
+                                     'datasetId': dataset,
+                                     'tableId': table},
+                'schema': {'fields': schema},
+                'sourceFormat': 'NEWLINE_DELIMITED_JSON',
+                'writeDisposition': 'WRITE_APPEND',
+            }},
+        }
+        try:
+            try:
+                job = bigquery.jobs().insert(
+                        projectId=project_id, body=body,
+                        media_body=http.MediaFileUpload(
+                                path, mimetype='application/octet-stream',
+                                resumable=True)).execute(
+                                        num_retries=NUM_RETRIES)
+            except errors.HttpError, e:
+                if e.resp.status != 409:
+                    raise
+                # The job was created by an earlier try of the request.
+                job = bigquery.jobs().get(
+                        projectId=project_id,
+                        jobId=body['jobReference']['jobId']).execute(
+                                num_retries=NUM_RETRIES)
+        except errors.HttpError, e:
+            if _is_retryable_http(e):
+                print "Retrying load: %s" % e
+                continue
+            return {'message': str(e)}
+        except Exception, e1:
+            print "Retrying load: %s" % e1
+            continue
+        job = _wait_for_job(bigquery, project_id, job)
+        if job is None:
+            # It was never created: submitting it again is safe.
+            print "Retrying load: job %s not found" % (
+                    body['jobReference']['jobId'])
+            continue
+        error = job['status'].get('errorResult')
+        if error is None:
+            return None
+        if error.get('reason') not in RETRYABLE_REASONS:
+            print "Rejected %s: %s" % (path, error)
+            return error
+        print "Retrying load: %s" % error
+        # The job failed without loading anything, so a new one can.
+        job_number += 1
+    print "Giving up on loading %s" % path
+    return False
+
+
+class _LoadFile(object):
+    """A gzipped newline-delimited JSON file of rows, being written by a
+    BigQueryLoader, to be loaded into table."""
+
+    def __init__(self, directory, table, deadline):
+        self.table = table
+        self.deadline = deadline
+        self.size = 0
+        # The (rows, callback) pairs written to the file.
+        self.batches = []
+        # The '$' of a partition decorator can't go in a job id.
+        fd, self.path = tempfile.mkstemp(
+                prefix='%s-' % table.replace('$', '-'), suffix='.json.gz',
+                dir=directory)
+        self._raw = os.fdopen(fd, 'wb')
+        self._file = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw)
+
+    def write(self, rows, callback):
+        for row in rows:
+            line = dumps(row) + '\n'
+            self._file.write(line)
+            self.size += len(line)
+        self.batches.append((rows, callback))
+
+    def close(self):
+        # Closing the GzipFile doesn't close the file it writes to.
+        self._file.close()
+        self._raw.close()
+
+
+class BigQueryLoader(object):
+    """Loads rows into a BigQuery table with load jobs, rather than
+    streaming them: an alternative to BigQueryInserter, with the same
+    interface, for when rows can wait a few minutes.
+
+    Batches of rows are written to gzipped newline-delimited JSON files in
+    directory, from a background thread. A file is closed once it holds
+    max_bytes of (uncompressed) rows, or max_age seconds after its first
+    batch, and loaded by one of the worker threads, each with its own
+    BigQuery client from the ClientPool clients. The callbacks of a file's
+    batches are called once it has been loaded, and it's then deleted.
+
+    If a file can't be loaded, all its rows have failed; if the job rejects
+    it because of invalid rows, all its rows are rejected, since load jobs
+    don't say which rows were invalid.
+
+    Each destination (see BigQueryInserter.insert()) gets files of its own.
+    The tables of destinations with a template suffix are created by their
+    load jobs, with schema, which can also be a function that returns the
+    schema, for one that changes.
+    """
+
+    def __init__(self, clients, project_id, dataset, table, directory,
+                 max_bytes=100000000, max_age=300, schema=None, workers=2,
+                 queue_size=8, on_latency=None, dead_letter=None):
+        self.clients = clients
+        # Unused: the rows of a batch are loaded long after it's written.
+        self.on_latency = on_latency
+        self.dead_letter = dead_letter
+        self.project_id = project_id
+        self.dataset = dataset
+        self.table = table
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.schema = schema if schema is not None else load_schema()
+        self.queue = Queue.Queue(queue_size)
+        self.files = Queue.Queue(workers)
+        self.batches = 0
+        self.rows = 0
+        self.rejected = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        metrics.gauge('bigquery_load_files',
+                      'Files waiting for a BigQuery load worker.',
+                      self.files.qsize)
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def insert(self, rows, callback=None, destination=None):
+        """Queue a batch of rows to be written to a file and loaded.
+
+        If given, callback is called from a worker thread with the rows that
+        couldn't be loaded, once the file has been loaded or given up on.
+        """
+        self.queue.put((rows, callback, destination))
+
+    def close(self):
+        """Load the queued batches, and stop the background threads."""
+        self.queue.put(None)
+        self._writer.join()
+        for _ in self._threads:
+            self.files.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _write(self):
+        # The open file of each destination.
+        files = {}
+        while True:
+            timeout = None
+            if files:
+                timeout = max(0, min(open_file.deadline
+                                     for open_file in files.itervalues()) -
+                              time.time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = False
+            if item:
+                rows, callback, destination = item
+                open_file = files.get(destination)
+                if open_file is None:
+                    table, suffix = destination or (self.table, None)
+                    open_file = files[destination] = _LoadFile(
+                            self.directory, table + (suffix or ''),
+                            time.time() + self.max_age)
+                open_file.write(rows, callback)
+            now = time.time()
+            for destination, open_file in files.items():
+                if (item is None or now >= open_file.deadline or
+                        open_file.size >= self.max_bytes):
+                    open_file.close()
+                    self.files.put(open_file)
+                    del files[destination]
+            if item is None:
+                return
+
+    def _run(self):
+        bigquery = self.clients.acquire()
+        try:
+            self._load_files(bigquery)
+        finally:
+            self.clients.release(bigquery)
+
+    def _load_files(self, bigquery):
+        while True:
+            item = self.files.get()
+            if item is None:
+                return
+            path, batches = item.path, item.batches
+            schema = self.schema() if callable(self.schema) else self.schema
+            rows = [row for batch, _ in batches for row in batch]
+            # Job ids can only contain letters, digits, '_' and '-'.
+            job_id = 'load-%s' % os.path.basename(path).split('.')[0]
+            start = time.time()
+            error = bq_load_file(bigquery, self.project_id, self.dataset,
+                                 item.table, path, schema, job_id)
+            LOAD_LATENCY.observe(time.time() - start)
+            LOAD_FILE_ROWS.observe(len(rows))
+            os.remove(path)
+            if error is None:
+                ROWS_INSERTED.inc(len(rows))
+                with self._lock:
+                    self.batches += len(batches)
+                    self.rows += len(rows)
+            elif error is False:
+                ROWS_FAILED.inc(len(rows))
+                with self._lock:
+                    self.failed += len(rows)
+            else:
+                ROWS_REJECTED.inc(len(rows))
+                with self._lock:
+                    self.rejected += len(rows)
+                if self.dead_letter is not None:
+                    try:
+                        self.dead_letter([{'row': row, 'errors': [error]}
+                                          for row in rows])
+                    except Exception, e:
+                        print "Problem writing rejected rows: %s" % e
+            for batch, callback in batches:
+                if callback is not None:
+                    try:
+                        callback(batch if error is False else [])
+                    except Exception, e:
+                        print "Problem handling loaded batch: %s" % e
+
+
+class _Batch(object):
+    """The pending rows of a Batcher, for one destination."""
+
+    __slots__ = ('rows', 'tokens', 'size', 'deadline')
+
+    def __init__(self, deadline):
+        self.rows = []
+        self.tokens = []
+        self.size = 0
+        self.deadline = deadline
+
+
+class Batcher(object):
+    """Collects rows into batches for BigQuery streaming inserts.
+
+    A batch is handed to flush when it reaches the row target, when its
+    estimated size reaches max_bytes, or when its oldest row has waited
+    max_linger seconds. flush is called with the list of rows, and the list
+    of tokens that were added with them, e.g. to acknowledge the messages
+    the rows came from once they're inserted. The row target moves between
+    min_rows and max_rows: it grows while full batches are inserted within
+    target_latency seconds, and is halved when they take longer.
+
+    If route is given, it's called with each row to get its destination
+    (see make_router()), and each destination gets batches of its own,
+    which are passed to flush as a third argument.
+    """
+
+    def __init__(self, flush, min_rows=50, max_rows=500, max_bytes=5000000,
+                 max_linger=2.0, target_latency=1.0, route=None):
+        self.flush = flush
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.target_latency = target_latency
+        self.route = route
+        self.target = min_rows
+        # The batches being filled, by destination.
+        self.pending = {}
+        self.batches = 0
+
+    def add(self, row, size, token=None):
+        """Add a row, given an estimate of its size in bytes."""
+        destination = self.route(row) if self.route is not None else None
+        batch = self.pending.get(destination)
+        if batch is not None and batch.size + size > self.max_bytes:
+            self._flush(destination)
+            batch = None
+        if batch is None:
+            batch = self.pending[destination] = _Batch(
+                    time.time() + self.max_linger)
+        batch.rows.append(row)
+        batch.tokens.append(token)
+        batch.size += size
+        if len(batch.rows) >= self.target:
+            self._flush(destination)
+
+    def poll(self):
+        """Flush the pending rows that have waited long enough."""
+        now = time.time()
+        for destination, batch in self.pending.items():
+            if now >= batch.deadline:
+                self._flush(destination)
+
+    def timeout(self):
+        """How long the caller can wait for more rows before calling poll(),
+        in seconds: 0 if a batch is already due, or None if there are no
+        pending rows.
+        """
+        if not self.pending:
+            return None
+        deadline = min(batch.deadline for batch in self.pending.itervalues())
+        return max(0, deadline - time.time())
+
+    def close(self):
+        """Flush any pending rows."""
+        for destination in self.pending.keys():
+            self._flush(destination)
+
+    def record_latency(self, rows, seconds):
+        """Adjust the row target, given how long a batch took to insert."""
+        if seconds > self.target_latency:
+            self.target = max(self.min_rows, self.target // 2)
+        elif rows >= self.target:
+            self.target = min(self.max_rows, self.target + self.min_rows)
+
+    def _flush(self, destination):
+        batch = self.pending.pop(destination)
+        self.batches += 1
+        if self.route is None:
+            self.flush(batch.rows, batch.tokens)
+        else:
+            self.flush(batch.rows, batch.tokens, destination)
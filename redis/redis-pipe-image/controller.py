@@ -15,15 +15,225 @@
 
 """A simple 'controller' script that determines which app script to run based
 on an environment variable.
+
+The script is run in this process, and run again whenever it finishes or
+fails, without paying for a new interpreter or new API clients. The BigQuery
+script can also be run in several processes at once, so that a pod can use
+more than one core.
+
+With RUNTIME set to 'gevent', the scripts' threads are run as greenlets,
+and their sockets don't block the process: each stage can then keep many
+more requests in flight, such as hundreds of BQ_INSERT_WORKERS, for little
+memory.
 """
 
 import os
 
+# 'threads' or 'gevent'. The standard library has to be patched for gevent
+# before anything else imports it.
+RUNTIME = os.environ.get('RUNTIME', 'threads')
+if RUNTIME == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif RUNTIME != 'threads':
+    raise ValueError('unknown RUNTIME %s' % RUNTIME)
+
+import imp
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import metrics
+import utils
+
+SCRIPTS = ('redis-to-bigquery', 'twitter-to-redis')
+CONSUMER_SCRIPT = 'redis-to-bigquery'
+# The number of processes to run the BigQuery script in. They all read from
+# the same Redis list, or share out its shards. A process that exits is
+# restarted, at most once every RESTART_DELAY seconds, and the processes'
+# combined counters are printed every STATS_INTERVAL seconds.
+CONSUMER_PROCESSES = int(os.environ.get('CONSUMER_PROCESSES', 1))
+RESTART_DELAY = int(os.environ.get('RESTART_DELAY', 10))
+STATS_INTERVAL = int(os.environ.get('STATS_INTERVAL', 60))
+# A script that keeps stopping is run again after longer and longer delays,
+# doubling from RESTART_DELAY up to RESTART_MAX_DELAY seconds, so that it
+# doesn't hammer a service that's down. The delay goes back to RESTART_DELAY
+# after a run that lasted RESTART_HEALTHY_TIME seconds.
+RESTART_MAX_DELAY = int(os.environ.get('RESTART_MAX_DELAY', 300))
+RESTART_HEALTHY_TIME = int(os.environ.get('RESTART_HEALTHY_TIME', 60))
+# How long to give the processes to finish their inserts when the controller
+# is asked to stop, before killing them.
+SHUTDOWN_TIMEOUT = int(os.environ.get('SHUTDOWN_TIMEOUT', 30))
+# The port the metrics are served on. Worker processes each serve theirs on
+# METRICS_PORT plus one plus their index, and the controller serves all of
+# them together on METRICS_PORT, with a 'worker' label.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+
+
+def load(script):
+    """Import the script as a module, so that its main() can be run here."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '%s.py' % script)
+    return imp.load_source(script.replace('-', '_'), path)
+
+
+def supervise(script):
+    """Run the script's main() over and over, until the script is asked to
+    stop, waiting between runs with exponential backoff.
+    """
+    module = load(script)
+    stopping = getattr(module, 'stopping', None)
+    if stopping is None:
+        # This process is PID 1 in its container, so SIGTERM would be
+        # ignored. Exit through the script's finally blocks instead.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    runs = 0
+    delay = RESTART_DELAY
+    while True:
+        runs += 1
+        started = time.time()
+        try:
+            module.main()
+        except Exception:
+            traceback.print_exc()
+            print '%s failed' % script
+        if stopping is not None and stopping.is_set():
+            return
+        if time.time() - started >= RESTART_HEALTHY_TIME:
+            delay = RESTART_DELAY
+        print 'starting run %s of %s in %s seconds' % (runs + 1, script, delay)
+        if stopping is not None:
+            if stopping.wait(delay):
+                return
+        else:
+            time.sleep(delay)
+        delay = min(delay * 2, RESTART_MAX_DELAY)
+
+
+class Worker(object):
+    """A process running the BigQuery script, which is restarted when it
+    exits. Its counters are kept across restarts.
+    """
+
+    def __init__(self, index, script, stats_dir):
+        self.index = index
+        self.script = script
+        self.stats_file = os.path.join(stats_dir, 'worker-%s.json' % index)
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        # The counters of this worker's previous processes.
+        self.totals = {}
+
+    def start(self):
+        if self.started:
+            self.restarts += 1
+        # The worker runs the script through this controller, so that it
+        # is also run again in-process when it finishes.
+        env = dict(os.environ, PROCESSINGSCRIPT=self.script,
+                   CONSUMER_PROCESSES='1', WORKER_INDEX=str(self.index),
+                   STATS_FILE=self.stats_file)
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(self.metrics_port())
+        self.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)], env=env)
+        self.started = time.time()
+
+    def metrics_port(self):
+        return METRICS_PORT + 1 + self.index
+
+    def poll(self):
+        """Whether the process has exited. If so, its counters are added to
+        the totals.
+        """
+        if self.process is None or self.process.poll() is None:
+            return False
+        print 'worker %s exited with status %s' % (
+                self.index, self.process.returncode)
+        utils.add_stats(self.totals, utils.read_stats(self.stats_file))
+        if os.path.exists(self.stats_file):
+            os.remove(self.stats_file)
+        self.process = None
+        return True
+
+    def stats(self):
+        stats = dict(self.totals)
+        if self.process is not None:
+            utils.add_stats(stats, utils.read_stats(self.stats_file))
+        return stats
+
+
+def print_stats(workers):
+    totals = {}
+    for worker in workers:
+        utils.add_stats(totals, worker.stats())
+    print 'workers: %s running, %s restarts; %s' % (
+            sum(1 for worker in workers if worker.process is not None),
+            sum(worker.restarts for worker in workers),
+            ', '.join('%s %s' % item for item in sorted(totals.items())))
+
+
+def stop_workers(workers):
+    """Ask the workers to finish up, and kill any that take too long."""
+    for worker in workers:
+        if worker.process is not None:
+            worker.process.terminate()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for worker in workers:
+        while not worker.poll() and worker.process is not None:
+            if time.time() >= deadline:
+                print 'killing worker %s' % worker.index
+                worker.process.kill()
+                worker.process.wait()
+            else:
+                time.sleep(0.1)
+
+
+def combined_metrics(workers):
+    """Return the metrics of all the running workers."""
+    expositions = []
+    for worker in workers:
+        if worker.process is not None:
+            text = metrics.fetch(worker.metrics_port())
+            if text is not None:
+                expositions.append((worker.index, text))
+    return metrics.combine(expositions, 'worker')
+
+
+def run_workers(script, count):
+    """Run count processes of the script until asked to stop."""
+    stats_dir = tempfile.mkdtemp(prefix='%s-' % script)
+    workers = [Worker(i, script, stats_dir) for i in range(count)]
+    metrics.serve(METRICS_PORT, lambda: combined_metrics(workers))
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    next_report = time.time() + STATS_INTERVAL
+    while not stopping:
+        for worker in workers:
+            worker.poll()
+            if (worker.process is None and
+                    time.time() - worker.started >= RESTART_DELAY):
+                worker.start()
+        if time.time() >= next_report:
+            next_report += STATS_INTERVAL
+            print_stats(workers)
+        time.sleep(1)
+    stop_workers(workers)
+    print_stats(workers)
+
+
 script = os.environ['PROCESSINGSCRIPT']
 
-if script == 'redis-to-bigquery':
-    os.system("python redis-to-bigquery.py")
-elif script == 'twitter-to-redis':
-    os.system("python twitter-to-redis.py")
+if script == CONSUMER_SCRIPT and CONSUMER_PROCESSES > 1:
+    run_workers(script, CONSUMER_PROCESSES)
+elif script in SCRIPTS:
+    supervise(script)
 else:
     print "unknown script %s" % script
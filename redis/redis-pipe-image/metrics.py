@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A small registry of pipeline metrics: counters, gauges and histograms.
+The metrics are served over HTTP, at /metrics, in the Prometheus text format.
+
+A process that runs several worker processes can serve all of their metrics
+on a single port instead, fetched from each worker and labelled with its
+index (see combine()).
+"""
+
+import BaseHTTPServer
+import bisect
+import collections
+import os
+import threading
+import urllib2
+
+# The port to serve the metrics on. 0 means they aren't served.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# Histogram buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+# Histogram buckets for the time taken to handle a single tweet, in seconds.
+TWEET_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                 0.01)
+# Histogram buckets for batch sizes, in rows.
+SIZE_BUCKETS = (1, 10, 25, 50, 100, 250, 500, 1000)
+
+# All the metrics, by (name, labels), in the order they were created.
+_metrics = collections.OrderedDict()
+_lock = threading.Lock()
+_server = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+            for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """A count that only goes up."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(object):
+    """A value that can go up and down. If function is set, it's called to
+    get the value whenever the metrics are read.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self.function is None:
+            return [(self.name, self.labels, self.value)]
+        try:
+            return [(self.name, self.labels, self.function())]
+        except Exception, e:
+            print 'Problem reading metric %s: %s' % (self.name, e)
+            return []
+
+
+class Histogram(object):
+    """Counts observed values in buckets, and keeps their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('%s_bucket' % self.name,
+                            self.labels + (('le', _format_value(bound)),),
+                            cumulative))
+        samples.append(('%s_sum' % self.name, self.labels, total))
+        samples.append(('%s_count' % self.name, self.labels, cumulative))
+        return samples
+
+
+def _register(cls, name, help, labels, *args):
+    """Return the metric with this name and labels, creating it if needed,
+    so that code run more than once in a process shares its metrics.
+    """
+    labels = tuple(sorted(labels.items()))
+    with _lock:
+        metric = _metrics.get((name, labels))
+        if metric is None:
+            metric = _metrics[name, labels] = cls(name, help, labels, *args)
+        return metric
+
+
+def counter(name, help, **labels):
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name, help, function=None, **labels):
+    metric = _register(Gauge, name, help, labels)
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def exposition():
+    """Return all the metrics, in the Prometheus text format."""
+    # The samples of metrics with the same name have to be listed together.
+    families = collections.OrderedDict()
+    with _lock:
+        for metric in _metrics.values():
+            families.setdefault(metric.name, []).append(metric)
+    lines = []
+    for name, metrics in families.iteritems():
+        lines.append('# HELP %s %s' % (name, metrics[0].help))
+        lines.append('# TYPE %s %s' % (name, metrics[0].type))
+        for metric in metrics:
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, _format_labels(labels),
+                                          _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def fetch(port, timeout=5):
+    """Return the metrics served on port on this host, or None if they
+    can't be read."""
+    try:
+        return urllib2.urlopen('http://localhost:%s/metrics' % port,
+                               timeout=timeout).read()
+    except Exception, e:
+        print 'Problem fetching metrics from port %s: %s' % (port, e)
+        return None
+
+
+def combine(expositions, label):
+    """Merge several expositions into one, adding the label, with the value
+    each exposition is given with, to all their samples.
+
+    expositions is a list of (label value, exposition text) pairs. The
+    samples of each metric are listed together, under a single HELP and
+    TYPE line.
+    """
+    families = collections.OrderedDict()
+    for value, text in expositions:
+        samples = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                if name not in families:
+                    families[name] = [line]
+                samples = families[name]
+            elif line.startswith('# TYPE '):
+                if len(samples) == 1:
+                    samples.append(line)
+            elif line and samples is not None:
+                sample, _, rest = line.rpartition(' ')
+                name, brace, labels = sample.partition('{')
+                added = '%s="%s"' % (label, value)
+                if brace:
+                    added += ',' + labels
+                else:
+                    added += '}'
+                samples.append('%s{%s %s' % (name, added, rest))
+    return ''.join('\n'.join(lines) + '\n' for lines in families.values())
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=METRICS_PORT, function=exposition):
+    """Serve the metrics on port from a background thread, unless port is 0
+    or they're already being served. function returns the metrics to serve.
+    """
+    global _server
+    if not port or _server is not None:
+        return
+    _server = BaseHTTPServer.HTTPServer(('', port), _Handler)
+    _server.exposition = function
+    thread = threading.Thread(target=_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'serving metrics on port %s' % port
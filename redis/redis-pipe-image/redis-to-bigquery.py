@@ -17,11 +17,18 @@
 using the BigQuery Streaming API.
 """
 import datetime
-import json
+import itertools
+import math
 import os
+import signal
+import socket
+import threading
+import time
 
 import redis
 
+import metrics
+import shards
 import utils
 
 # Get info on the Redis host and port from the environment variables.
@@ -29,31 +36,452 @@ import utils
 REDIS_HOST = os.environ['REDISMASTER_SERVICE_HOST']
 REDIS_PORT = os.environ['REDISMASTER_SERVICE_PORT']
 REDIS_LIST = os.environ['REDISLIST']
+# The most tweets to take from Redis in one round trip, and how long (in
+# seconds) to block waiting for the first one. The wait is kept short, and
+# at least a second (Redis would take 0 to mean forever), so that an idle
+# consumer still notices when it's asked to stop.
+REDIS_BATCH_SIZE = int(os.environ.get('REDIS_BATCH_SIZE', 50))
+REDIS_BLOCK_TIMEOUT = max(1, int(os.environ.get('REDIS_BLOCK_TIMEOUT', 5)))
+# In reliable queue mode, tweets are moved to a processing list for this
+# consumer, and only removed from it once they've been written to BigQuery.
+# A consumer is presumed dead, and its processing list is moved back onto
+# the main list, if it hasn't sent a heartbeat for REDIS_CONSUMER_TTL seconds.
+REDIS_RELIABLE_QUEUE = os.environ.get('REDIS_RELIABLE_QUEUE') == 'true'
+REDIS_CONSUMER_TTL = int(os.environ.get('REDIS_CONSUMER_TTL', 30))
+CONSUMER_ID = '%s-%s' % (socket.gethostname(), os.getpid())
+# When the queue is spread over several shards (see shards.py), the
+# consumers share them out between them. Each one records the time of its
+# latest heartbeat in this hash, on the first shard's host, and is dropped
+# from it if it misses them for REDIS_CONSUMER_TTL seconds.
+MEMBERS_KEY = '%s:members' % REDIS_LIST
 
-r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+# Atomically moves up to ARGV[1] of the oldest items in list KEYS[1] onto
+# list KEYS[2], and returns them, oldest first.
+MOVE_BATCH = """
+local items = redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+local n = #items
+if n == 0 then
+  return items
+end
+redis.call('LTRIM', KEYS[1], 0, -n - 1)
+local moved = {}
+for i = n, 1, -1 do
+  moved[#moved + 1] = items[i]
+end
+redis.call('LPUSH', KEYS[2], unpack(moved))
+return moved
+"""
+
+# Atomically moves all of the items in the processing list KEYS[1] back
+# onto the tail of the main list KEYS[2], so they are the next to be popped,
+# and removes consumer ARGV[1] from the set KEYS[3]. Returns the number of
+# items moved.
+RECOVER_LIST = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = 1, #items, 1000 do
+  redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+return #items
+"""
 
 # Get the project ID from the environment variable set in
 # the 'bigquery-controller.yaml' manifest.
 PROJECT_ID = os.environ['PROJECT_ID']
+# How rows are written to BigQuery: 'stream' sends them with streaming
+# inserts, and 'load' writes them to gzipped newline-delimited JSON files in
+# BQ_LOAD_DIR, which are loaded with load jobs once they hold
+# BQ_LOAD_MAX_BYTES of rows or are BQ_LOAD_MAX_AGE seconds old. Load jobs
+# are free, but rows take minutes rather than seconds to show up.
+BQ_SINK = os.environ.get('BQ_SINK', 'stream')
+BQ_LOAD_DIR = os.environ.get('BQ_LOAD_DIR', '/tmp/bq-load')
+BQ_LOAD_MAX_BYTES = int(os.environ.get('BQ_LOAD_MAX_BYTES', 100000000))
+BQ_LOAD_MAX_AGE = float(os.environ.get('BQ_LOAD_MAX_AGE', 300))
+# The number of concurrent BigQuery inserts, and the number of batches that
+# can wait for a free insert worker.
+BQ_INSERT_WORKERS = int(os.environ.get('BQ_INSERT_WORKERS', 4))
+BQ_INSERT_QUEUE_SIZE = int(os.environ.get('BQ_INSERT_QUEUE_SIZE', 8))
+# Batches are sent when they reach a row target, which adapts between
+# BQ_BATCH_MIN_ROWS and BQ_BATCH_MAX_ROWS to keep inserts within
+# BQ_TARGET_LATENCY seconds, when they reach BQ_BATCH_MAX_BYTES, or when
+# their oldest row has waited BQ_BATCH_MAX_LINGER seconds.
+BQ_BATCH_MIN_ROWS = int(os.environ.get('BQ_BATCH_MIN_ROWS', 50))
+BQ_BATCH_MAX_ROWS = int(os.environ.get('BQ_BATCH_MAX_ROWS', 500))
+BQ_BATCH_MAX_BYTES = int(os.environ.get('BQ_BATCH_MAX_BYTES', 5000000))
+BQ_BATCH_MAX_LINGER = float(os.environ.get('BQ_BATCH_MAX_LINGER', 2))
+BQ_TARGET_LATENCY = float(os.environ.get('BQ_TARGET_LATENCY', 1))
+# Which table each row goes to: 'none' sends them all to BQ_TABLE, 'day' to
+# the partition of BQ_TABLE for the day they were created (BQ_TABLE must be
+# a day-partitioned table), 'lang' to a table per language, e.g.
+# BQ_TABLE_en, and 'keyword' to a table per keyword, the first one in the
+# comma-separated BQ_ROUTING_KEYWORDS found in their text. Each table gets
+# batches of its own.
+BQ_ROUTING = os.environ.get('BQ_ROUTING', 'none')
+BQ_ROUTING_KEYWORDS = os.environ.get('BQ_ROUTING_KEYWORDS', '').split(',')
+# If 'true', fields that tweets have and the table's schema doesn't are
+# added to the schema as they show up, every BQ_SCHEMA_UPDATE_INTERVAL
+# seconds, rather than being dropped.
+BQ_SCHEMA_UPDATES = os.environ.get('BQ_SCHEMA_UPDATES') == 'true'
+BQ_SCHEMA_UPDATE_INTERVAL = float(os.environ.get('BQ_SCHEMA_UPDATE_INTERVAL',
+                                                 60))
+# If set, rows that can't be inserted into BigQuery, or that wait more than
+# BQ_SPILL_AFTER seconds for an insert worker, are written to a spill log
+# on local disk in this directory, and inserted from there once BigQuery
+# keeps up again. The log holds up to BQ_SPILL_MAX_BYTES, in segments of
+# BQ_SPILL_SEGMENT_BYTES, and is replayed in batches of BQ_SPILL_REPLAY_ROWS.
+BQ_SPILL_DIR = os.environ.get('BQ_SPILL_DIR')
+BQ_SPILL_AFTER = float(os.environ.get('BQ_SPILL_AFTER', 10))
+BQ_SPILL_MAX_BYTES = int(os.environ.get('BQ_SPILL_MAX_BYTES', 1000000000))
+BQ_SPILL_SEGMENT_BYTES = int(os.environ.get('BQ_SPILL_SEGMENT_BYTES',
+                                            16000000))
+BQ_SPILL_REPLAY_ROWS = int(os.environ.get('BQ_SPILL_REPLAY_ROWS', 500))
+# If set, rows that BigQuery rejects as invalid are pushed onto this Redis
+# list, along with their errors, instead of being dropped.
+BQ_DEAD_LETTER_LIST = os.environ.get('BQ_DEAD_LETTER_LIST')
+# The number of recently seen tweet ids to remember, to drop duplicates.
+DEDUP_CACHE_SIZE = int(os.environ.get('DEDUP_CACHE_SIZE', 100000))
+# Set by controller.py when it runs several consumer processes: the file
+# this process writes its counters to, for the controller to add up.
+STATS_FILE = os.environ.get('STATS_FILE')
+
+# Set when the process is asked to stop, so that it finishes its inserts
+# before exiting.
+stopping = threading.Event()
+# The counters of earlier runs of main() in this process, which are
+# included in the stats file.
+run_totals = {}
+
+# Compile the table schema once, up front, into the tweet transformer. With
+# BQ_SCHEMA_UPDATES, it's compiled again whenever fields are added.
+schema_registry = utils.SchemaRegistry(utils.load_schema())
+# BigQuery clients, kept for reuse when main() is run again.
+bigquery_clients = utils.ClientPool(utils.create_bigquery_client)
+# The thread started by start_heartbeat(), in reliable queue mode or when
+# the queue is sharded.
+_heartbeat_thread = None
+# The shards this consumer reads, set by update_assignment(), and the
+# number of pops so far, to take turns between them.
+assigned = []
+_pops = itertools.count()
+
+TWEETS_READ = metrics.counter(
+        'tweets_read_total',
+        'Items read from Redis: stream frames, or packed batches of rows.')
+TWEETS_CLEANED = metrics.counter('tweets_cleaned_total',
+                                 'Tweets transformed into BigQuery rows.')
+DROPPED_CONTROL, DROPPED_INVALID, DROPPED_DUPLICATE = [
+        metrics.counter('tweets_dropped_total',
+                        'Stream frames not sent to BigQuery, by reason.',
+                        reason=reason)
+        for reason in ('control', 'invalid', 'duplicate')]
+FETCH_LATENCY = metrics.histogram(
+        'redis_fetch_latency_seconds',
+        'Time taken to pop a batch of tweets from Redis, including blocking.')
+CLEANUP_TIME = metrics.histogram(
+        'tweet_cleanup_seconds', 'Time taken to transform a tweet into a row.',
+        metrics.TWEET_BUCKETS)
+
+
+def processing_list(redis_list, consumer_id):
+    return '%s:processing:%s' % (redis_list, consumer_id)
+
+
+def heartbeat_key(redis_list, consumer_id):
+    return '%s:heartbeat:%s' % (redis_list, consumer_id)
+
+
+class Shard(object):
+    """One of the Redis lists the queue is spread over, with this consumer's
+    processing list for it, in reliable queue mode, and the set of the
+    consumers that have one.
+    """
+
+    def __init__(self, r, redis_list):
+        self.r = r
+        self.redis_list = redis_list
+        self.processing_list = processing_list(redis_list, CONSUMER_ID)
+        self.consumers_key = '%s:consumers' % redis_list
+        self.move_batch = r.register_script(MOVE_BATCH)
+        self.recover_list = r.register_script(RECOVER_LIST)
+
+    def pop(self, max_items, timeout):
+        """Pop up to max_items tweets from the list, oldest first.
+
+        Blocks for up to timeout seconds until the first tweet is available,
+        then takes any others that are already waiting with take(), so a
+        whole batch costs two round trips rather than one per tweet. The
+        timeout is rounded up to whole seconds, and to at least one, since
+        Redis takes 0 to mean forever.
+        """
+        timeout = max(1, int(math.ceil(timeout)))
+        if REDIS_RELIABLE_QUEUE:
+            # Move the tweet to the processing list, until it's written.
+            first = self.r.brpoplpush(self.redis_list, self.processing_list,
+                                      timeout=timeout)
+        else:
+            res = self.r.brpop(self.redis_list, timeout=timeout)
+            first = res[1] if res is not None else None
+        if first is None:
+            return []
+        items = [first]
+        if max_items > 1:
+            items.extend(self.take(max_items - 1))
+        return items
+
+    def take(self, max_items):
+        """Pop up to max_items tweets from the list, oldest first, without
+        waiting for any."""
+        if REDIS_RELIABLE_QUEUE:
+            return self.move_batch(
+                    keys=[self.redis_list, self.processing_list],
+                    args=[max_items])
+        # New tweets are pushed onto the head of the list, so the oldest
+        # ones are at the tail.
+        pipe = self.r.pipeline()
+        pipe.lrange(self.redis_list, -max_items, -1)
+        pipe.ltrim(self.redis_list, 0, -max_items - 1)
+        items, _ = pipe.execute()
+        items.reverse()
+        return items
+
+    def ack(self, items):
+        """Remove handled tweets from this consumer's processing list."""
+        pipe = self.r.pipeline(transaction=False)
+        for item in items:
+            # Tweets are acknowledged roughly in the order they were popped,
+            # so they're found quickest by searching from the tail.
+            pipe.lrem(self.processing_list, -1, item)
+        pipe.execute()
+
+    def register(self):
+        """Register this consumer, or keep its registration alive, and
+        reclaim the processing lists of consumers that have gone away.
+        Returns the number of tweets recovered."""
+        self.r.setex(heartbeat_key(self.redis_list, CONSUMER_ID),
+                     REDIS_CONSUMER_TTL, 1)
+        self.r.sadd(self.consumers_key, CONSUMER_ID)
+        recovered = 0
+        for consumer in self.r.smembers(self.consumers_key):
+            if self.r.exists(heartbeat_key(self.redis_list, consumer)):
+                continue
+            recovered += self.recover(consumer)
+        return recovered
+
+    def recover(self, consumer=CONSUMER_ID):
+        """Move the tweets in a consumer's processing list back onto the
+        list, and unregister it. Returns the number of tweets moved."""
+        return self.recover_list(
+                keys=[processing_list(self.redis_list, consumer),
+                      self.redis_list, self.consumers_key],
+                args=[consumer])
+
+
+# A client for each Redis host, shared by the shards on it.
+_clients = {}
+SHARDS = []
+for host, port, redis_list in shards.layout(REDIS_LIST, REDIS_HOST,
+                                            REDIS_PORT):
+    if (host, port) not in _clients:
+        _clients[host, port] = redis.StrictRedis(host=host, port=port, db=0)
+    SHARDS.append(Shard(_clients[host, port], redis_list))
+# The first shard's host also keeps the consumers' membership, and the
+# dead-letter list.
+r = SHARDS[0].r
+
+
+def update_assignment():
+    """Renew this consumer's membership, and work out which shards it reads
+    from the consumers that are still alive."""
+    global assigned
+    if len(SHARDS) == 1:
+        assigned = SHARDS
+        return
+    now = time.time()
+    members = r.hgetall(MEMBERS_KEY)
+    dead = [member for member, seen in members.iteritems()
+            if float(seen) < now - REDIS_CONSUMER_TTL]
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(MEMBERS_KEY, CONSUMER_ID, now)
+    if dead:
+        pipe.hdel(MEMBERS_KEY, *dead)
+    pipe.execute()
+    owned = [SHARDS[index] for index in shards.assign(
+            set(members) - set(dead), CONSUMER_ID, len(SHARDS))]
+    if owned != assigned:
+        print 'reading shards %s of %s' % (
+                ', '.join(shard.redis_list for shard in owned), len(SHARDS))
+        assigned = owned
+
+
+def leave():
+    """Give up this consumer's shards, for the others to take over."""
+    r.hdel(MEMBERS_KEY, CONSUMER_ID)
+
+
+def heartbeat():
+    """Keep this consumer's membership and, in reliable queue mode, its
+    registration on each shard alive. Also reclaim the processing lists of
+    consumers that have gone away since, and pick up the shards of those
+    that have joined or left."""
+    while True:
+        try:
+            update_assignment()
+            if REDIS_RELIABLE_QUEUE:
+                recovered = sum(shard.register() for shard in SHARDS)
+                if recovered:
+                    print ('Recovered %s tweets from dead consumers.' %
+                           recovered)
+        except Exception, e:
+            print 'Problem sending heartbeat to Redis: %s' % e
+        time.sleep(REDIS_CONSUMER_TTL / 3.0)
+
 
+def start_heartbeat():
+    """Start the heartbeat thread, unless it's already running. Otherwise,
+    re-register this consumer, since recover() unregisters it.
+    """
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        if REDIS_RELIABLE_QUEUE:
+            for shard in SHARDS:
+                shard.r.sadd(shard.consumers_key, CONSUMER_ID)
+        return
+    _heartbeat_thread = threading.Thread(target=heartbeat)
+    _heartbeat_thread.daemon = True
+    _heartbeat_thread.start()
+
+
+def ack(keys):
+    """Remove handled tweets from this consumer's processing lists, given
+    (shard, item) pairs."""
+    items = {}
+    for shard, item in keys:
+        items.setdefault(shard, []).append(item)
+    for shard, shard_items in items.iteritems():
+        shard.ack(shard_items)
+
+
+def pop_batch(max_items, timeout):
+    """Pop up to max_items tweets from one of the shards this consumer
+    reads, oldest first. Returns the shard and the tweets.
+
+    With a single shard, this blocks for up to timeout seconds until a
+    tweet is available. With several, it takes what's waiting on each of
+    them in turn, starting from a different one each time, and only blocks
+    on one of them, for at most a second, when they're all empty, so as to
+    get back to the others soon, and to the shards the heartbeat assigns
+    this consumer when another joins or leaves.
+    """
+    owned = assigned
+    if len(SHARDS) == 1:
+        return owned[0], owned[0].pop(max_items, timeout)
+    start = next(_pops)
+    for i in range(len(owned)):
+        shard = owned[(start + i) % len(owned)]
+        items = shard.take(max_items)
+        if items:
+            return shard, items
+    shard = owned[start % len(owned)]
+    return shard, shard.pop(max_items, min(timeout, 1))
+
+
+def dead_letter(rejected):
+    """Push rows rejected by BigQuery onto the dead-letter list."""
+    r.lpush(BQ_DEAD_LETTER_LIST, *[utils.dumps(entry) for entry in rejected])
+
+
+def create_inserter(dead_letter):
+    """Create the sink rows are written to BigQuery with: a
+    BigQueryInserter, or a BigQueryLoader if BQ_SINK is 'load'."""
+    if BQ_SINK == 'load':
+        print 'loading rows from files in %s' % BQ_LOAD_DIR
+        return utils.BigQueryLoader(
+                bigquery_clients, PROJECT_ID,
+                os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+                BQ_LOAD_DIR, BQ_LOAD_MAX_BYTES, BQ_LOAD_MAX_AGE,
+                schema=lambda: schema_registry.fields,
+                dead_letter=dead_letter)
+    spill = None
+    if BQ_SPILL_DIR:
+        # Each of the processes run by controller.py has its own log.
+        directory = os.path.join(BQ_SPILL_DIR,
+                                 os.environ.get('WORKER_INDEX', '0'))
+        spill = utils.SpillLog(directory, BQ_SPILL_MAX_BYTES,
+                               BQ_SPILL_SEGMENT_BYTES)
+    return utils.BigQueryInserter(
+            bigquery_clients, PROJECT_ID,
+            os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+            BQ_INSERT_WORKERS, BQ_INSERT_QUEUE_SIZE, dead_letter=dead_letter,
+            spill=spill, spill_after=BQ_SPILL_AFTER,
+            replay_rows=BQ_SPILL_REPLAY_ROWS)
+
+
+def stop(signum, frame):
+    """Signal handler that makes the write loop exit."""
+    stopping.set()
+
+
+def write_to_bq(inserter):
+    """Write the data to BigQuery in small chunks, until count_max batches
+    have been sent or the process is asked to stop. Closes the inserter.
+    """
+
+    def send(rows, elements, destination=None):
+        if not REDIS_RELIABLE_QUEUE:
+            inserter.insert(rows, destination=destination)
+            return
+
+        def inserted(failed):
+            # Items with rows that failed stay in the processing list, and
+            # are recovered when this consumer exits.
+            failed = set(id(row) for row in failed)
+            ack([element.key for row, element in zip(rows, elements)
+                 if element.finish_row(id(row) in failed) and
+                 not element.failed])
+        inserter.insert(rows, inserted, destination)
+
+    batcher = utils.Batcher(send, BQ_BATCH_MIN_ROWS,
+                            BQ_BATCH_MAX_ROWS, BQ_BATCH_MAX_BYTES,
+                            BQ_BATCH_MAX_LINGER, BQ_TARGET_LATENCY,
+                            utils.make_router(BQ_ROUTING,
+                                              os.environ['BQ_TABLE'],
+                                              BQ_ROUTING_KEYWORDS))
+    inserter.on_latency = batcher.record_latency
+    dedup = utils.DuplicateFilter(DEDUP_CACHE_SIZE)
+
+    def stats():
+        return {'batches': batcher.batches, 'rows': inserter.rows,
+                'rejected': inserter.rejected, 'failed': inserter.failed,
+                'duplicates': dedup.duplicates}
+
+    def save_stats():
+        if STATS_FILE:
+            utils.write_stats(STATS_FILE,
+                              utils.add_stats(dict(run_totals), stats()))
 
-def write_to_bq(bigquery):
-    """Write the data to BigQuery in small chunks."""
-    tweets = []
-    CHUNK = 50  # The size of the BigQuery insertion batch.
     tweet = None
     mtweet = None
-    count = 0
     count_max = 50000
+    next_report = 25
     redis_errors = 0
     allowed_redis_errors = 3
-    while count < count_max:
-        while len(tweets) < CHUNK:
+    try:
+        while batcher.batches < count_max and not stopping.is_set():
+            # Send off the pending tweets if they've waited long enough.
+            batcher.poll()
             # We'll use a blocking list pop -- it returns when there is
-            # new data.
-            res = None
+            # new data, or when it's time to send the pending tweets. Its
+            # timeout is in whole seconds, and 0 means forever, so pending
+            # tweets are waited for for at least a second.
+            timeout = batcher.timeout()
+            if timeout is None:
+                timeout = REDIS_BLOCK_TIMEOUT
+            else:
+                timeout = max(1, int(math.ceil(timeout)))
+            start = time.time()
             try:
-                res = r.brpop(REDIS_LIST)
+                shard, items = pop_batch(REDIS_BATCH_SIZE, timeout)
             except:
                 print 'Problem getting data from Redis.'
                 redis_errors += 1
@@ -61,35 +489,121 @@ def write_to_bq(bigquery):
                     print "Too many redis errors: exiting."
                     return
                 continue
-            try:
-                tweet = json.loads(res[1])
-            except Exception, e:
-                print e
-                redis_errors += 1
-                if redis_errors > allowed_redis_errors:
-                    print "Too many redis-related errors: exiting."
-                    return
-                continue
-            # First do some massaging of the raw data
-            mtweet = utils.cleanup(tweet)
-            # We only want to write tweets to BigQuery; we'll skip 'delete' and
-            # 'limit' information.
-            if 'delete' in mtweet:
-                continue
-            if 'limit' in mtweet:
-                continue
-            tweets.append(mtweet)
-        # try to insert the tweets into bigquery
-        response = utils.bq_data_insert(bigquery, PROJECT_ID, os.environ['BQ_DATASET'],
-                             os.environ['BQ_TABLE'], tweets)
-        tweets = []
-        count += 1
-        if count % 25 == 0:
-            print ("processing count: %s of %s at %s: %s" %
-                   (count, count_max, datetime.datetime.now(), response))
+            FETCH_LATENCY.observe(time.time() - start)
+            TWEETS_READ.inc(len(items))
+            # Items that won't be written to BigQuery.
+            skipped = []
+            cleaned = 0
+            for item in items:
+                if utils.is_packed(item):
+                    # A batch of rows the producer has already projected.
+                    try:
+                        rows, size = utils.unpack_rows(item)
+                    except Exception, e:
+                        print 'Problem unpacking rows: %s' % e
+                        DROPPED_INVALID.inc()
+                        skipped.append(item)
+                        continue
+                    # With no rows, nothing would ever finish the element.
+                    if not rows:
+                        skipped.append(item)
+                        continue
+                    element = utils.Element((shard, item), len(rows))
+                    for row in rows:
+                        if dedup.is_duplicate(row.get('id_str')):
+                            DROPPED_DUPLICATE.inc()
+                            if element.finish_row() and not element.failed:
+                                skipped.append(item)
+                            continue
+                        cleaned += 1
+                        batcher.add(row, size / len(rows), element)
+                    continue
+                # Only tweets go to BigQuery: skip 'delete' and 'limit'
+                # notices, without parsing them when possible.
+                if utils.is_control_frame(item):
+                    DROPPED_CONTROL.inc()
+                    skipped.append(item)
+                    continue
+                # Anything wrong with the item, from bad JSON to a date that
+                # can't be parsed, drops it, rather than failing the run: it
+                # would only be read again, and fail it again.
+                try:
+                    tweet = utils.loads(item)
+                    if not isinstance(tweet, dict):
+                        raise ValueError('Not a JSON object: %.100s' % item)
+                    if 'delete' in tweet or 'limit' in tweet:
+                        DROPPED_CONTROL.inc()
+                        skipped.append(item)
+                        continue
+                    if dedup.is_duplicate(tweet.get('id_str')):
+                        DROPPED_DUPLICATE.inc()
+                        skipped.append(item)
+                        continue
+                    # First do some massaging of the raw data
+                    start = time.time()
+                    mtweet = schema_registry.transform(tweet)
+                    CLEANUP_TIME.observe(time.time() - start)
+                except Exception, e:
+                    print 'Dropping invalid tweet: %s' % e
+                    DROPPED_INVALID.inc()
+                    skipped.append(item)
+                    continue
+                cleaned += 1
+                # queue the tweet for insertion into bigquery
+                batcher.add(mtweet, len(item), utils.Element((shard, item)))
+            TWEETS_CLEANED.inc(cleaned)
+            if REDIS_RELIABLE_QUEUE:
+                ack([(shard, item) for item in skipped])
+            if batcher.batches >= next_report:
+                next_report += 25
+                print ("processing count: %s of %s at %s: %s rows inserted, "
+                       "%s rejected, %s failed, %s duplicates, "
+                       "batch target %s rows" %
+                       (batcher.batches, count_max, datetime.datetime.now(),
+                        inserter.rows, inserter.rejected, inserter.failed,
+                        dedup.duplicates, batcher.target))
+                save_stats()
+    finally:
+        batcher.close()
+        inserter.close()
+        save_stats()
+        utils.add_stats(run_totals, stats())
 
 
-if __name__ == '__main__':
+def main():
+    """Run the pipeline until count_max batches have been written, or the
+    process is asked to stop. Can be run again in the same process.
+    """
     print "starting write to BigQuery...."
-    bigquery = utils.create_bigquery_client()
-    write_to_bq(bigquery)
+    signal.signal(signal.SIGTERM, stop)
+    metrics.serve()
+    if BQ_SCHEMA_UPDATES:
+        schema_registry.start(bigquery_clients, PROJECT_ID,
+                              os.environ['BQ_DATASET'], os.environ['BQ_TABLE'],
+                              BQ_SCHEMA_UPDATE_INTERVAL)
+    metrics.gauge('redis_list_length',
+                  'Tweets waiting in the Redis lists of all the shards.',
+                  lambda: sum(shard.r.llen(shard.redis_list)
+                              for shard in SHARDS))
+    update_assignment()
+    if REDIS_RELIABLE_QUEUE:
+        print 'using reliable queue mode, as consumer %s' % CONSUMER_ID
+    if REDIS_RELIABLE_QUEUE or len(SHARDS) > 1:
+        start_heartbeat()
+    inserter = create_inserter(
+            dead_letter if BQ_DEAD_LETTER_LIST else None)
+    try:
+        write_to_bq(inserter)
+    finally:
+        # Even if the run failed, and is about to be started again in this
+        # process, while the heartbeat keeps this consumer alive.
+        if len(SHARDS) > 1:
+            leave()
+        if REDIS_RELIABLE_QUEUE:
+            # Put back any tweets that couldn't be written.
+            for shard in SHARDS:
+                shard.recover()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spreads the Redis queue over several lists ("shards"), optionally on
+several Redis hosts, so that the producers and consumers don't all contend
+for a single list on a single Redis CPU.
+
+The producer pushes each tweet onto the shard its id hashes to, so copies
+of a tweet that's sent twice go to the same shard, and the consumers share
+the shards out between them (see assign()).
+"""
+
+import os
+import zlib
+
+# The number of lists the queue is spread over. With a single shard, the
+# queue is the REDISLIST list itself.
+REDIS_SHARDS = int(os.environ.get('REDIS_SHARDS', 1))
+# If set, a comma-separated list of host:port addresses of Redis servers to
+# spread the shards over, round robin: shard i is on the i-th server,
+# modulo their number. By default, all the shards are on the redis-master
+# service.
+REDIS_SHARD_HOSTS = os.environ.get('REDIS_SHARD_HOSTS', '')
+
+
+def layout(redis_list, host, port, shards=REDIS_SHARDS,
+           hosts=REDIS_SHARD_HOSTS):
+    """Returns a (host, port, list name) triple for each shard."""
+    addresses = [address.strip() for address in hosts.split(',')
+                 if address.strip()]
+    if not addresses:
+        addresses = ['%s:%s' % (host, port)]
+    result = []
+    for index in range(shards):
+        host, _, port = addresses[index % len(addresses)].partition(':')
+        name = redis_list if shards == 1 else '%s:%d' % (redis_list, index)
+        result.append((host, int(port or 6379), name))
+    return result
+
+
+def frame_key(frame):
+    """Returns the key a stream frame is sharded by: the first 'id_str' in
+    it, found without parsing the frame, or the frame itself if it has
+    none. It isn't always the tweet's own id, but it's the same every time
+    the same tweet is sent.
+    """
+    start = frame.find('"id_str":')
+    if start < 0:
+        return frame
+    start = frame.find('"', start + 9) + 1
+    end = frame.find('"', start)
+    if start <= 0 or end < 0:
+        return frame
+    return frame[start:end]
+
+
+def shard_of(key, shards):
+    """Returns the index of the shard for key, out of shards."""
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+def assign(members, member, shards):
+    """Returns the indexes of the shards that member reads, when shards are
+    shared out between members, a list of consumer ids.
+
+    Every member works out the same assignment, as long as they see the
+    same members. Each shard is read by one member, unless there are more
+    members than shards; then some shards are read by more than one, so
+    that none of the members are idle.
+    """
+    members = sorted(set(members) | set([member]))
+    index = members.index(member)
+    if len(members) > shards:
+        return [index % shards]
+    return range(index, shards, len(members))
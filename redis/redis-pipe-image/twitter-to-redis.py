@@ -19,12 +19,19 @@ to pull in tweets and store them in a Redis server.
 
 import datetime
 import os
+import Queue
+import threading
+import time
 
 import redis
 from tweepy import OAuthHandler
 from tweepy import Stream
 from tweepy.streaming import StreamListener
 
+import metrics
+import shards
+import utils
+
 # Get your twitter credentials from the environment variables.
 # These are set in the 'twitter-stream.json' manifest file.
 consumer_key = os.environ['CONSUMERKEY']
@@ -37,6 +44,152 @@ access_token_secret = os.environ['ACCESSTOKENSEC']
 REDIS_HOST = os.environ['REDISMASTER_SERVICE_HOST']
 REDIS_PORT = os.environ['REDISMASTER_SERVICE_PORT']
 REDIS_LIST = os.environ['REDISLIST']
+# Tweets are buffered in memory and pushed to Redis in batches of up to
+# REDIS_BATCH_SIZE, at least every REDIS_FLUSH_INTERVAL seconds. If Redis
+# falls behind and the buffer holds REDIS_BUFFER_SIZE tweets, new tweets are
+# dropped (and counted) rather than stalling the Twitter stream.
+REDIS_BATCH_SIZE = int(os.environ.get('REDIS_BATCH_SIZE', 100))
+REDIS_FLUSH_INTERVAL = float(os.environ.get('REDIS_FLUSH_INTERVAL', 0.5))
+REDIS_BUFFER_SIZE = int(os.environ.get('REDIS_BUFFER_SIZE', 10000))
+# If "true", tweets are projected onto the BigQuery schema before they're
+# pushed, and each batch of them is pushed as a single compressed item,
+# which the consumers unpack. This makes the data in Redis several times
+# smaller, and saves the consumers the projection.
+PACK_TWEETS = os.environ.get('PACK_TWEETS') == 'true'
+
+# The tweet transformer used when packing tweets.
+transform = utils.compile_schema(utils.load_schema()) if PACK_TWEETS else None
+
+TWEETS_RECEIVED = metrics.counter('tweets_received_total',
+                                  'Stream frames received from Twitter.')
+TWEETS_PUSHED = metrics.counter('redis_pushed_total',
+                                'Stream frames pushed to Redis.')
+TWEETS_DROPPED = metrics.counter(
+        'redis_dropped_total',
+        'Stream frames dropped because the Redis buffer was full.')
+PUSH_ERRORS = metrics.counter('redis_push_errors_total',
+                              'Failed pushes of a batch to Redis.')
+PUSHED_BYTES = metrics.counter('redis_pushed_bytes_total',
+                               'Bytes of items pushed to Redis.')
+PUSH_LATENCY = metrics.histogram('redis_push_latency_seconds',
+                                 'Time taken to push a batch to Redis.')
+
+
+class RedisWriter(object):
+    """Buffers tweets, and pushes them to Redis lists in batches.
+
+    targets is a list of (Redis client, list name) pairs, one per shard of
+    the queue; each tweet is pushed onto the one its key hashes to (see
+    shards.py). The pushes happen on a background thread, so that Redis
+    latency doesn't hold up the thread reading the Twitter stream. If
+    transform is given, the tweets of a batch bound for each shard are
+    projected with it, and pushed as a single packed item (see
+    utils.pack_frames).
+    """
+
+    def __init__(self, targets, batch_size=REDIS_BATCH_SIZE,
+                 flush_interval=REDIS_FLUSH_INTERVAL,
+                 buffer_size=REDIS_BUFFER_SIZE, transform=None):
+        self.targets = targets
+        self.transform = transform
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = Queue.Queue(buffer_size)
+        self.pushed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_buffered = 0
+        self._closed = threading.Event()
+        metrics.gauge('redis_buffered_tweets',
+                      'Stream frames waiting to be pushed to Redis.',
+                      self.buffer.qsize)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, tw):
+        """Buffer a tweet. Returns False if it was dropped."""
+        try:
+            self.buffer.put_nowait(tw)
+        except Queue.Full:
+            self.dropped += 1
+            TWEETS_DROPPED.inc()
+            return False
+        buffered = self.buffer.qsize()
+        if buffered > self.max_buffered:
+            self.max_buffered = buffered
+        if buffered > self.buffer.maxsize / 2:
+            # Greenlets aren't preempted: with the gevent runtime, the
+            # stream reader has to let the pushes catch up.
+            time.sleep(0)
+        return True
+
+    def close(self):
+        """Push any buffered tweets, and stop the background thread."""
+        self._closed.set()
+        self._thread.join()
+
+    def _next_batch(self):
+        """Wait for a batch of tweets: it's ready when it's full, or when
+        flush_interval has passed since its first tweet arrived."""
+        try:
+            batch = [self.buffer.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.buffer.get(timeout=timeout))
+                else:
+                    batch.append(self.buffer.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        start = time.time()
+        if len(self.targets) == 1:
+            groups = {0: batch}
+        else:
+            groups = {}
+            for frame in batch:
+                index = shards.shard_of(shards.frame_key(frame),
+                                        len(self.targets))
+                groups.setdefault(index, []).append(frame)
+        try:
+            # One round trip to each Redis host.
+            pipes = {}
+            size = 0
+            for index, items in groups.iteritems():
+                if self.transform is not None:
+                    packed = utils.pack_frames(items, self.transform)
+                    if packed is None:
+                        continue
+                    items = [packed]
+                r, redis_list = self.targets[index]
+                pipe = pipes.get(id(r))
+                if pipe is None:
+                    pipe = pipes[id(r)] = r.pipeline(transaction=False)
+                pipe.lpush(redis_list, *items)
+                size += sum(len(item) for item in items)
+            for pipe in pipes.itervalues():
+                pipe.execute()
+            self.pushed += len(batch)
+            TWEETS_PUSHED.inc(len(batch))
+            PUSHED_BYTES.inc(size)
+            PUSH_LATENCY.observe(time.time() - start)
+        except Exception, e:
+            print 'Problem adding data to Redis: %s' % e
+            self.errors += 1
+            PUSH_ERRORS.inc()
+
+    def _run(self):
+        while not (self._closed.is_set() and self.buffer.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
 
 
 class StdOutListener(StreamListener):
@@ -45,43 +198,56 @@ class StdOutListener(StreamListener):
     """
 
     count = 0
-    redis_errors = 0
     allowed_redis_errors = 3
-    twstring = ''
-    tweets = []
-    r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
     total_tweets = 10000000
 
+    def __init__(self, api=None):
+        super(StdOutListener, self).__init__(api)
+        # A client for each Redis host, shared by the shards on it.
+        clients = {}
+        targets = []
+        for host, port, redis_list in shards.layout(REDIS_LIST, REDIS_HOST,
+                                                    REDIS_PORT):
+            if (host, port) not in clients:
+                clients[host, port] = redis.StrictRedis(host=host, port=port,
+                                                        db=0)
+            targets.append((clients[host, port], redis_list))
+        self.writer = RedisWriter(targets, transform=transform)
+
     def write_to_redis(self, tw):
-        try:
-            self.r.lpush(REDIS_LIST, tw)
-        except:
-            print 'Problem adding data to Redis.'
-            self.redis_errors += 1
+        self.writer.put(tw)
 
     def on_data(self, data):
         """What to do when tweet data is received."""
         self.write_to_redis(data)
         self.count += 1
-        # if we've grabbed more than total_tweets tweets, exit the script.
-        # If this script is being run in the context of a kubernetes
-        # replicationController, the pod will be restarted fresh when
-        # that happens.
+        TWEETS_RECEIVED.inc()
+        # if we've grabbed more than total_tweets tweets, stop streaming.
+        # If this script is being run by controller.py, it will be started
+        # again, in the same process, when that happens.
         if self.count > self.total_tweets:
             return False
-        if self.redis_errors > self.allowed_redis_errors:
+        if self.writer.errors > self.allowed_redis_errors:
             print 'too many redis errors.'
             return False
         if (self.count % 1000) == 0:
-            print 'count is: %s at %s' % (self.count, datetime.datetime.now())
+            print ('count is: %s at %s (buffered: %s, max buffered: %s, '
+                   'dropped: %s)' % (self.count, datetime.datetime.now(),
+                                     self.writer.buffer.qsize(),
+                                     self.writer.max_buffered,
+                                     self.writer.dropped))
         return True
 
     def on_error(self, status):
         print status
 
 
-if __name__ == '__main__':
+def main():
+    """Stream tweets until total_tweets have been read, or the stream ends.
+    Can be run again in the same process.
+    """
     print '....'
+    metrics.serve()
     listener = StdOutListener()
     auth = OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
@@ -92,15 +258,24 @@ if __name__ == '__main__':
     # will sample the twitter public stream. If not 'sample', instead track
     # the given set of keywords.
     # This environment var is set in the 'twitter-stream.yaml' file.
-    if os.environ['TWSTREAMMODE'] == 'sample':
-        stream.sample()
-    else:
-        stream.filter(
-                track=['bigdata', 'kubernetes', 'bigquery', 'docker', 'google',
-                       'googlecloud', 'golang', 'dataflow',
-                       'containers', 'appengine', 'gcp', 'compute',
-                       'scalability', 'gigaom', 'news', 'tech', 'apple',
-                       'amazon', 'cluster', 'distributed', 'computing',
-                       'cloud', 'android', 'mobile', 'ios', 'iphone',
-                       'python', 'recode', 'techcrunch', 'timoreilly']
-                )
+    try:
+        if os.environ['TWSTREAMMODE'] == 'sample':
+            stream.sample()
+        else:
+            stream.filter(
+                    track=['bigdata', 'kubernetes', 'bigquery', 'docker',
+                           'google', 'googlecloud', 'golang', 'dataflow',
+                           'containers', 'appengine', 'gcp', 'compute',
+                           'scalability', 'gigaom', 'news', 'tech', 'apple',
+                           'amazon', 'cluster', 'distributed', 'computing',
+                           'cloud', 'android', 'mobile', 'ios', 'iphone',
+                           'python', 'recode', 'techcrunch', 'timoreilly']
+                    )
+    finally:
+        # Send what's buffered, and stop the background threads, even if
+        # the stream failed.
+        listener.writer.close()
+
+
+if __name__ == '__main__':
+    main()